@@ -0,0 +1,308 @@
+"""Offline end-to-end benchmark for the bot.
+
+Local stand-ins for api.vxtwitter.com, t.co, twimg and the Telegram Bot API run in a separate
+process (so they don't count towards the bot's memory), the bot is pointed at them through its
+config, and handle_message is driven with synthetic updates for each scenario.
+
+    python bench.py --iterations 50 --concurrency 8 --latency-ms 40 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import resource
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from os import path
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+import config
+
+# Tweet ids start with the digit of their kind, so the stand-in knows what media to return
+KINDS = {'1': 'photo', '2': 'photos', '3': 'gif', '4': 'video', '5': 'large_video'}
+SCENARIOS = ['photo', 'photos', 'gif', 'video', 'large_video', 'multi_link']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves every stand-in service, routed by the first path segment."""
+
+    protocol_version = 'HTTP/1.1'
+    options: argparse.Namespace = None
+    calls = {}
+    lock = threading.Lock()
+    ids = count(1)
+    payloads = {}
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def count_call(self, service: str) -> None:
+        with self.lock:
+            self.calls[service] = self.calls.get(service, 0) + 1
+
+    def failing(self, service: str, error_rate: float) -> bool:
+        time.sleep(getattr(self.options, f'{service}_latency_ms') / 1000)
+        return random.random() < error_rate
+
+    def send_body(self, body: bytes, content_type: str = 'application/json', status: int = 200,
+                  headers: dict = None) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The bot only reads the headers of videos it sends by url
+                self.close_connection = True
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        service, _, rest = urlsplit(self.path).path.lstrip('/').partition('/')
+        if service == '__stats':
+            return self.send_body(json.dumps(self.calls).encode())
+        if service == '__reset':
+            with self.lock:
+                self.calls.clear()
+            return self.send_body(b'{}')
+        if service == 'vx':
+            return self.vxtwitter(rest.rsplit('/', 1)[-1])
+        if service == 'tco':
+            self.count_call('tco')
+            if self.failing('tco', self.options.error_rate):
+                return self.send_body(b'', status=500)
+            return self.send_body(b'', status=301, headers={'Location': f'/x.com/bench/status/{rest[1:]}'})
+        if service == 'x.com':
+            return self.send_body(b'<html></html>', 'text/html')
+        if service == 'media':
+            return self.media(rest)
+        if service.startswith('bot'):
+            return self.telegram(rest)
+        self.send_body(b'', status=404)
+
+    def do_POST(self) -> None:
+        self.do_GET()
+
+    def vxtwitter(self, tweet_id: str) -> None:
+        self.count_call('vxtwitter')
+        if self.failing('vxtwitter', self.options.error_rate):
+            return self.send_body(b'{}', status=500)
+        kind = KINDS[tweet_id[0]]
+        base = f'http://127.0.0.1:{self.server.server_address[1]}/media'
+        if kind in ('photo', 'photos'):
+            media = [{'type': 'image', 'url': f'{base}/{tweet_id}_{i}.jpg?name=large'}
+                     for i in range(1 if kind == 'photo' else 4)]
+        else:
+            media = [{'type': 'gif' if kind == 'gif' else 'video', 'url': f'{base}/{tweet_id}_{kind}.mp4'}]
+        self.send_body(json.dumps({
+            'text': f'Benchmark tweet {tweet_id} https://t.co/abc', 'tweetID': tweet_id,
+            'tweetURL': f'https://twitter.com/bench/status/{tweet_id}', 'user_name': 'Bench',
+            'user_screen_name': 'bench', 'media_extended': media,
+        }).encode())
+
+    def media(self, name: str) -> None:
+        self.count_call('media')
+        if self.failing('media', self.options.error_rate):
+            return self.send_body(b'', status=500)
+        if name.endswith('_large_video.mp4'):
+            size = self.options.large_video_size
+        elif name.endswith('.mp4'):
+            size = self.options.video_size
+        else:
+            size = self.options.photo_size
+        if size not in self.payloads:
+            self.payloads[size] = bytes(size)
+        self.send_body(self.payloads[size], 'video/mp4' if name.endswith('.mp4') else 'image/jpeg')
+
+    def telegram(self, method: str) -> None:
+        body = self.read_body()
+        self.count_call('telegram')
+        if self.failing('telegram', self.options.telegram_error_rate):
+            return self.send_body(json.dumps({'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                              'parameters': {'retry_after': 1}}).encode(), status=429)
+        fields = {}
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            fields = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        elif self.headers.get('Content-Type', '').startswith('application/json'):
+            fields = json.loads(body or b'{}')
+        self.send_body(json.dumps({'ok': True, 'result': self.telegram_result(method, fields)}).encode())
+
+    def telegram_file(self, **extra) -> dict:
+        file_id = next(self.ids)
+        return {'file_id': f'F{file_id}', 'file_unique_id': f'U{file_id}', **extra}
+
+    def telegram_message(self, method: str, media: dict = None) -> dict:
+        message = {'message_id': next(self.ids), 'date': int(time.time()),
+                   'chat': {'id': self.options.chat_id, 'type': 'private'}}
+        if method == 'sendPhoto' or (media or {}).get('type') == 'photo':
+            message['photo'] = [self.telegram_file(width=1280, height=720)]
+        elif method == 'sendDocument' or (media or {}).get('type') == 'document':
+            message['document'] = self.telegram_file()
+        elif method == 'sendAnimation':
+            message['animation'] = self.telegram_file(width=480, height=480, duration=3)
+            message['document'] = message['animation']
+        elif method == 'sendVideo':
+            message['video'] = self.telegram_file(width=1280, height=720, duration=10)
+        else:
+            message['text'] = 'ok'
+        return message
+
+    def telegram_result(self, method: str, fields: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'sendMediaGroup':
+            media = fields.get('media', '[]')
+            return [self.telegram_message(method, item) for item in (json.loads(media) if isinstance(media, str) else media)]
+        if method.startswith('send') or method == 'editMessageText':
+            return self.telegram_message(method)
+        return True
+
+
+def serve(options: argparse.Namespace, ports: multiprocessing.Queue) -> None:
+    """Run the stand-in services until the process is terminated."""
+    StandInHandler.options = options
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def tweet_ids(kind: str, scenario: str, iteration: int, repeat: bool) -> str:
+    digit = next(digit for digit, name in KINDS.items() if name == kind)
+    # Every scenario gets its own tweets, so none starts with caches warmed by an earlier one
+    return f'{digit}{SCENARIOS.index(scenario):02d}{0 if repeat else iteration:09d}'
+
+
+def message_text(scenario: str, iteration: int, repeat: bool) -> str:
+    if scenario != 'multi_link':
+        return f'https://x.com/bench/status/{tweet_ids(scenario, scenario, iteration, repeat)}'
+    # A link dump: direct links, t.co links and a mix of media kinds
+    links = [f'https://twitter.com/bench/status/{tweet_ids("photos", scenario, iteration, repeat)}',
+             f'https://t.co/b{tweet_ids("photo", scenario, iteration, repeat)}',
+             f'https://x.com/bench/status/{tweet_ids("gif", scenario, iteration, repeat)}',
+             f'https://t.co/b{tweet_ids("video", scenario, iteration, repeat)}',
+             f'https://x.com/bench/status/{tweet_ids("photo", scenario, iteration + 1_000_000, repeat)}']
+    return '\n'.join(links)
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_scenario(main, application, base: str, scenario: str, options: argparse.Namespace,
+                       update_ids: count) -> dict:
+    urlopen(f'{base}/__reset').read()
+    latencies = []
+    slots = asyncio.Semaphore(options.concurrency)
+
+    async def handle(iteration: int) -> None:
+        async with slots:
+            update_id = next(update_ids)
+            update = main.Update.de_json({
+                'update_id': update_id,
+                'message': {'message_id': update_id, 'date': int(time.time()),
+                            'chat': {'id': options.chat_id, 'type': 'private'},
+                            'from': {'id': options.chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                            'text': message_text(scenario, iteration, options.repeat)},
+            }, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(iteration) for iteration in range(options.iterations)))
+    elapsed = time.perf_counter() - started
+    calls = json.loads(urlopen(f'{base}/__stats').read())
+    return {
+        'scenario': scenario,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'msg_per_s': options.iterations / elapsed,
+        **{f'{service}/msg': calls.get(service, 0) / options.iterations
+           for service in ('vxtwitter', 'tco', 'media', 'telegram')},
+    }
+
+
+async def run(options: argparse.Namespace, base: str) -> list:
+    # The bot reads its config at import time, so point it at the stand-ins first
+    config.VXTWITTER_API_URL = f'{base}/vx'
+    # Only vxtwitter has a stand-in, so keep hedged requests from reaching the real fallback
+    config.METADATA_PROVIDERS = ['vxtwitter']
+    config.TCO_URL = f'{base}/tco'
+    config.TELEGRAM_API_URL = f'{base}/bot'
+    config.TELEGRAM_FILE_URL = f'{base}/file/bot'
+    config.DEVELOPER_ID = options.chat_id
+    data_dir = tempfile.mkdtemp(prefix='bench')
+    config.DATABASE_PATH = path.join(data_dir, 'persistence.sqlite3')
+    config.MEDIA_CACHE_DIR = path.join(data_dir, 'media')
+    if options.no_rate_limit:
+        # The stand-in has no flood control, so the only throttling left would be the bot's own
+        config.GLOBAL_SEND_RATE = config.GLOBAL_SEND_BURST = config.CHAT_SEND_BURST = 10 ** 6
+        config.CHAT_SEND_RATE = config.GROUP_SEND_RATE = 10 ** 6
+    import main
+
+    application = main.build_application()
+    await application.initialize()
+    update_ids = count(1)
+    try:
+        return [await run_scenario(main, application, base, scenario, options, update_ids)
+                for scenario in options.scenarios]
+    finally:
+        await application.shutdown()
+        await main.post_shutdown(application)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--iterations', type=int, default=20, help='messages sent per scenario')
+    parser.add_argument('--concurrency', type=int, default=4, help='messages in flight at once')
+    parser.add_argument('--repeat', action='store_true', help='reuse the same tweets (warm caches)')
+    parser.add_argument('--no-rate-limit', action='store_true',
+                        help="lift the bot's send rate limits to measure the bot rather than its send scheduler")
+    parser.add_argument('--latency-ms', type=float, default=30, help='default latency of every stand-in')
+    for service in ('vxtwitter', 'tco', 'media', 'telegram'):
+        parser.add_argument(f'--{service}-latency-ms', type=float, help=f'latency of the {service} stand-in')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failing vxtwitter/t.co/media calls')
+    parser.add_argument('--telegram-error-rate', type=float, default=0.0, help='share of Bot API calls answered 429')
+    parser.add_argument('--photo-size', type=int, default=300_000)
+    parser.add_argument('--video-size', type=int, default=5_000_000)
+    parser.add_argument('--large-video-size', type=int, default=25_000_000)
+    parser.add_argument('--chat-id', type=int, default=config.DEVELOPER_ID)
+    options = parser.parse_args()
+    for service in ('vxtwitter', 'tco', 'media', 'telegram'):
+        if getattr(options, f'{service}_latency_ms') is None:
+            setattr(options, f'{service}_latency_ms', options.latency_ms)
+
+    ports = multiprocessing.Queue()
+    stand_in = multiprocessing.Process(target=serve, args=(options, ports), daemon=True)
+    stand_in.start()
+    try:
+        results = asyncio.run(run(options, f'http://127.0.0.1:{ports.get(timeout=10)}'))
+    finally:
+        stand_in.terminate()
+
+    columns = list(results[0])
+    print(' '.join(f'{column:>14}' for column in columns))
+    for result in results:
+        print(' '.join(f'{value:>14.2f}' if isinstance(value, float) else f'{value:>14}' for value in result.values()))
+    # The peak of the whole run; a process's peak can't be reset between scenarios
+    print(f'peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
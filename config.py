@@ -1,3 +1,64 @@
 BOT_TOKEN = "123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11"  # Your telegram bot token
 DEVELOPER_ID = 1234567890  # Your telegram id (used for error reporting and private mode)
 IS_BOT_PRIVATE = False  # Change this to True to make bot private
+TWEET_CACHE_SIZE = 1024  # Max number of tweets kept in the metadata cache
+TWEET_CACHE_TTL = 600  # Seconds before cached tweet metadata is fetched again
+HTTP_MAX_CONNECTIONS = 200  # Max open connections of the shared HTTP client
+HTTP_MAX_KEEPALIVE = 40  # Max idle keep-alive connections kept in the pool
+HTTP_TIMEOUT = (5, 30)  # (connect, read) timeouts in seconds for outbound requests
+HTTP_RETRIES = 3  # Retries for failed GET/HEAD requests
+HTTP_BACKOFF = 0.5  # Backoff factor between retries
+FILE_ID_CACHE_SIZE = 10000  # Max number of Telegram file_ids remembered for re-sending media
+CONCURRENT_UPDATES = 256  # Max Telegram updates handled at once
+MAX_CONCURRENT_TWEETS = 1000  # Max tweets prepared at once across all chats
+MAX_CONCURRENT_TWEETS_PER_CHAT = 4  # Max tweets prepared at once for a single chat
+PROBE_ORIG_PHOTOS = True  # Check 'orig' photo quality exists before sending; if False, fall back on send failure
+MAX_CONCURRENT_PROBES = 32  # Max 'orig' quality probes in flight
+ORIG_PROBE_CACHE_SIZE = 4096  # Max number of probe results remembered
+ORIG_PROBE_CACHE_TTL = 3600  # Seconds before a photo url is probed again
+LARGE_VIDEO_CHUNK_SIZE = 1048576  # Bytes read per chunk when transferring videos too big to send by url
+STREAM_LARGE_VIDEOS = False  # Upload large videos while downloading them instead of buffering in a temp file
+MAX_CONCURRENT_LARGE_TRANSFERS = 2  # Max large videos transferred at once
+UPLOAD_TIMEOUT = 300  # Seconds to wait for a large video upload to finish
+PROGRESS_INTERVAL = 3  # Seconds between progress updates on the upload status message
+MEDIA_CACHE_DIR = 'data/media'  # Directory keeping downloaded large videos for re-uploads
+MEDIA_CACHE_SIZE = 2147483648  # Max total bytes of the media cache, least recently used files are removed first
+DATABASE_PATH = 'data/persistence.sqlite3'  # SQLite file holding bot data, stats and media caches
+PERSISTENCE_UPDATE_INTERVAL = 60  # Seconds between writes of changed bot/chat/user data
+GLOBAL_SEND_RATE = 25  # Messages per second the bot sends across all chats
+GLOBAL_SEND_BURST = 30  # Messages the bot may send at once across all chats
+CHAT_SEND_RATE = 1  # Messages per second sent to a single private chat
+GROUP_SEND_RATE = 0.33  # Messages per second sent to a single group or channel
+CHAT_SEND_BURST = 10  # Messages that may be sent to a single chat at once (an album is one message)
+SEND_MAX_RETRIES = 3  # Times a send is retried after Telegram's flood control (RetryAfter)
+UPDATE_MODE = 'polling'  # 'polling' or 'webhook'
+WEBHOOK_LISTEN = '0.0.0.0'  # Address the webhook listener binds to
+WEBHOOK_PORT = 8443  # Port the webhook listener binds to
+WEBHOOK_PATH = 'telegram'  # Path the webhook listener accepts updates on
+WEBHOOK_URL = 'https://example.com/telegram'  # Public url Telegram sends updates to (e.g. your load balancer)
+WEBHOOK_SECRET_TOKEN = ''  # Secret Telegram sends with every update, required in webhook mode (1-256 of A-Z, a-z, 0-9, _ and -)
+WEBHOOK_MAX_CONNECTIONS = 40  # Max simultaneous connections Telegram opens to deliver updates
+VXTWITTER_API_URL = 'https://api.vxtwitter.com'  # Tweet metadata API
+FXTWITTER_API_URL = 'https://api.fxtwitter.com'  # Fallback tweet metadata API
+TCO_URL = 'https://t.co'  # Link shortener that t.co links are resolved against
+TELEGRAM_API_URL = 'https://api.telegram.org/bot'  # Bot API endpoint (the token is appended)
+TELEGRAM_FILE_URL = 'https://api.telegram.org/file/bot'  # Bot API file endpoint (the token is appended)
+METRICS_LISTEN = '127.0.0.1'  # Address the Prometheus metrics endpoint binds to
+METRICS_PORT = 9464  # Port of the Prometheus metrics endpoint (0 disables it)
+METADATA_PROVIDERS = ['vxtwitter', 'fxtwitter']  # Tweet metadata providers, preferred first while equally healthy
+METADATA_HEDGE_DELAY = 1.5  # Seconds to wait on a metadata provider before also asking the next one
+PROVIDER_FAILURE_THRESHOLD = 5  # Consecutive failures before a metadata provider is skipped
+PROVIDER_COOLDOWN = 30  # Seconds a failing metadata provider is skipped before it is tried again
+TCO_CACHE_SIZE = 100000  # Max number of resolved t.co links remembered
+TCO_MAX_REDIRECTS = 5  # Redirects followed from a t.co link before giving up on reaching a tweet url
+JOB_WORKERS = 0  # Worker processes replying from the durable tweet queue (0 replies in the bot process itself)
+QUEUE_PATH = 'data/queue.sqlite3'  # SQLite file holding queued tweet jobs
+WORKER_CONCURRENCY = 64  # Max jobs a worker process handles at once
+JOB_LEASE = 120  # Seconds a job stays claimed by a worker without a renewal before it is handed out again
+JOB_MAX_ATTEMPTS = 3  # Times a job is handed out before it is dropped
+JOB_POLL_INTERVAL = 0.2  # Seconds an idle worker waits before checking the queue again
+WORKER_METRICS_INTERVAL = 10  # Seconds between worker processes publishing their metrics for /metrics and /stats
+INLINE_CACHE_SIZE = 10000  # Max number of tweets kept ready to answer inline queries
+INLINE_PAGE_SIZE = 50  # Inline results sent per page (Telegram allows at most 50)
+INLINE_CACHE_TIME = 300  # Seconds Telegram may cache an inline answer
+INLINE_FETCH_TIMEOUT = 5  # Seconds an inline query waits on a tweet that isn't cached yet
@@ -1,3 +1,64 @@
 BOT_TOKEN = "${{ secrets.bot_token }}"
 DEVELOPER_ID = int("${{ secrets.developer_id }}")
 IS_BOT_PRIVATE = False
+TWEET_CACHE_SIZE = 1024
+TWEET_CACHE_TTL = 600
+HTTP_MAX_CONNECTIONS = 200
+HTTP_MAX_KEEPALIVE = 40
+HTTP_TIMEOUT = (5, 30)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+FILE_ID_CACHE_SIZE = 10000
+CONCURRENT_UPDATES = 256
+MAX_CONCURRENT_TWEETS = 1000
+MAX_CONCURRENT_TWEETS_PER_CHAT = 4
+PROBE_ORIG_PHOTOS = True
+MAX_CONCURRENT_PROBES = 32
+ORIG_PROBE_CACHE_SIZE = 4096
+ORIG_PROBE_CACHE_TTL = 3600
+LARGE_VIDEO_CHUNK_SIZE = 1048576
+STREAM_LARGE_VIDEOS = False
+MAX_CONCURRENT_LARGE_TRANSFERS = 2
+UPLOAD_TIMEOUT = 300
+PROGRESS_INTERVAL = 3
+MEDIA_CACHE_DIR = 'data/media'
+MEDIA_CACHE_SIZE = 2147483648
+DATABASE_PATH = 'data/persistence.sqlite3'
+PERSISTENCE_UPDATE_INTERVAL = 60
+GLOBAL_SEND_RATE = 25
+GLOBAL_SEND_BURST = 30
+CHAT_SEND_RATE = 1
+GROUP_SEND_RATE = 0.33
+CHAT_SEND_BURST = 10
+SEND_MAX_RETRIES = 3
+UPDATE_MODE = 'polling'
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'
+WEBHOOK_URL = ''
+WEBHOOK_SECRET_TOKEN = ''
+WEBHOOK_MAX_CONNECTIONS = 40
+VXTWITTER_API_URL = 'https://api.vxtwitter.com'
+FXTWITTER_API_URL = 'https://api.fxtwitter.com'
+TCO_URL = 'https://t.co'
+TELEGRAM_API_URL = 'https://api.telegram.org/bot'
+TELEGRAM_FILE_URL = 'https://api.telegram.org/file/bot'
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9464
+METADATA_PROVIDERS = ['vxtwitter', 'fxtwitter']
+METADATA_HEDGE_DELAY = 1.5
+PROVIDER_FAILURE_THRESHOLD = 5
+PROVIDER_COOLDOWN = 30
+TCO_CACHE_SIZE = 100000
+TCO_MAX_REDIRECTS = 5
+JOB_WORKERS = 0
+QUEUE_PATH = 'data/queue.sqlite3'
+WORKER_CONCURRENCY = 64
+JOB_LEASE = 120
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 0.2
+WORKER_METRICS_INTERVAL = 10
+INLINE_CACHE_SIZE = 10000
+INLINE_PAGE_SIZE = 50
+INLINE_CACHE_TIME = 300
+INLINE_FETCH_TIMEOUT = 5
@@ -1,77 +1,1053 @@
+import asyncio
+import hashlib
 import html
 import json
 import logging
+import mmap
+import multiprocessing
+import pickle
+import sqlite3
+import sys
+import time
 import traceback
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from functools import wraps
+from heapq import heappop, heappush
 from io import StringIO
-from os import makedirs
-from tempfile import TemporaryFile
-from typing import List, Optional
+from itertools import count
+from os import fsync, getpid, link, makedirs, path, remove, scandir, utime
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, Union
 from urllib.parse import urlsplit
+from uuid import uuid4
 
 import re
-import requests
+import httpx
 
 try:
     import re2 as re
 except ImportError:
     import re
 import telegram.error
-from telegram.error import TimedOut, BadRequest
-from telegram import Update, InputMediaAnimation,InputMediaPhoto,InputMediaDocument, constants, BotCommand, BotCommandScopeChat, ParseMode
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, PicklePersistence
-
-from config import BOT_TOKEN, DEVELOPER_ID, IS_BOT_PRIVATE
+from telegram.error import TimedOut, BadRequest, RetryAfter
+from telegram import Update, InputMediaPhoto, InputMediaDocument, constants, BotCommand, BotCommandScopeChat, Message, \
+    InlineQueryResultPhoto, InlineQueryResultCachedPhoto, InlineQueryResultMpeg4Gif, InlineQueryResultCachedMpeg4Gif, \
+    InlineQueryResultVideo, InlineQueryResultCachedVideo
+from telegram.constants import ParseMode
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, BasePersistence, \
+    PersistenceInput, BaseRateLimiter, InlineQueryHandler
+
+from config import BOT_TOKEN, DEVELOPER_ID, IS_BOT_PRIVATE, TWEET_CACHE_SIZE, TWEET_CACHE_TTL, HTTP_MAX_CONNECTIONS, \
+    HTTP_MAX_KEEPALIVE, HTTP_TIMEOUT, HTTP_RETRIES, HTTP_BACKOFF, FILE_ID_CACHE_SIZE, CONCURRENT_UPDATES, \
+    MAX_CONCURRENT_TWEETS, MAX_CONCURRENT_TWEETS_PER_CHAT, PROBE_ORIG_PHOTOS, MAX_CONCURRENT_PROBES, \
+    ORIG_PROBE_CACHE_SIZE, ORIG_PROBE_CACHE_TTL, LARGE_VIDEO_CHUNK_SIZE, STREAM_LARGE_VIDEOS, \
+    MAX_CONCURRENT_LARGE_TRANSFERS, UPLOAD_TIMEOUT, PROGRESS_INTERVAL, DATABASE_PATH, PERSISTENCE_UPDATE_INTERVAL, \
+    GLOBAL_SEND_RATE, GLOBAL_SEND_BURST, CHAT_SEND_RATE, GROUP_SEND_RATE, CHAT_SEND_BURST, SEND_MAX_RETRIES, \
+    UPDATE_MODE, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, \
+    VXTWITTER_API_URL, TCO_URL, TELEGRAM_API_URL, TELEGRAM_FILE_URL, METRICS_LISTEN, METRICS_PORT, \
+    FXTWITTER_API_URL, METADATA_PROVIDERS, METADATA_HEDGE_DELAY, PROVIDER_FAILURE_THRESHOLD, PROVIDER_COOLDOWN, \
+    TCO_CACHE_SIZE, TCO_MAX_REDIRECTS, MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE, QUEUE_PATH, JOB_WORKERS, \
+    WORKER_CONCURRENCY, JOB_LEASE, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL, INLINE_CACHE_SIZE, INLINE_PAGE_SIZE, \
+    INLINE_CACHE_TIME, INLINE_FETCH_TIMEOUT, WORKER_METRICS_INTERVAL
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def extract_tweet_ids(update: Update) -> Optional[List[str]]:
-    """Extract tweet IDs from message."""
-    text = update.effective_message.text
+class Metrics:
+    """Per-stage latency histograms, error counters and cache hit rates, rendered in the Prometheus text format.
+
+    Worker processes publish theirs to the store, where the bot picks them up to report on the whole pipeline."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self) -> None:
+        # stage -> [count per bucket..., count above the last bucket], sum of seconds
+        self.histograms: Dict[str, Tuple[List[int], List[float]]] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], int] = {}
+        self.caches: Dict[str, 'TTLCache'] = {}
+
+    def observe(self, stage: str, seconds: float) -> None:
+        buckets, total = self.histograms.setdefault(stage, ([0] * (len(self.BUCKETS) + 1), [0.0]))
+        buckets[next((i for i, bound in enumerate(self.BUCKETS) if seconds <= bound), len(self.BUCKETS))] += 1
+        total[0] += seconds
 
-    # For t.co links
-    unshortened_links = ''
-    for link in re.findall(r"t\.co\/[a-zA-Z0-9]+", text):
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
         try:
-            unshortened_link = requests.get('https://' + link).url
-            unshortened_links += '\n' + unshortened_link
-            log_handling(update, 'info', f'Unshortened t.co link [https://{link} -> {unshortened_link}]')
-        except:
-            log_handling(update, 'info', f'Could not unshorten link [https://{link}]')
-
-    # Parse IDs from received text
-    tweet_ids = re.findall(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})", text + unshortened_links)
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def incr(self, name: str, **labels: Any) -> None:
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + 1
+
+    def snapshot(self) -> dict:
+        """This process's metrics as plain data."""
+        return {
+            'histograms': {stage: (list(buckets), total[0]) for stage, (buckets, total) in self.histograms.items()},
+            'counters': dict(self.counters),
+            'caches': {name: (cache.hits, cache.misses) for name, cache in self.caches.items()},
+        }
+
+    def publish(self) -> None:
+        store.set('metrics', getpid(), self.snapshot())
+
+    def merged(self) -> dict:
+        """Snapshot of this process added up with those published by worker processes."""
+        merged = {'histograms': {}, 'counters': {}, 'caches': {}}
+        for snapshot in [self.snapshot(), *store.items('metrics').values()]:
+            for stage, (buckets, total) in snapshot['histograms'].items():
+                seen, seen_total = merged['histograms'].get(stage, ([0] * len(buckets), 0.0))
+                merged['histograms'][stage] = ([a + b for a, b in zip(seen, buckets)], seen_total + total)
+            for key, value in snapshot['counters'].items():
+                merged['counters'][key] = merged['counters'].get(key, 0) + value
+            for name, (hits, misses) in snapshot['caches'].items():
+                seen_hits, seen_misses = merged['caches'].get(name, (0, 0))
+                merged['caches'][name] = (seen_hits + hits, seen_misses + misses)
+        return merged
+
+    def quantile(self, buckets: List[int], q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile of a histogram (inf if above the last bucket)."""
+        seen = 0
+        for bound, n in zip(self.BUCKETS + (float('inf'),), buckets):
+            seen += n
+            if seen >= q * sum(buckets):
+                return bound
+        return float('inf')
+
+    def render(self) -> str:
+        merged = self.merged()
+        lines = ['# TYPE twidl_stage_seconds histogram']
+        for stage, (buckets, total) in sorted(merged['histograms'].items()):
+            seen = 0
+            for bound, n in zip(self.BUCKETS + ('+Inf',), buckets):
+                seen += n
+                lines.append(f'twidl_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {seen}')
+            lines.append(f'twidl_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'twidl_stage_seconds_count{{stage="{stage}"}} {seen}')
+        counters = merged['counters']
+        for name, (hits, misses) in merged['caches'].items():
+            counters[('cache_hits_total', (('cache', name),))] = hits
+            counters[('cache_misses_total', (('cache', name),))] = misses
+        for name, value in store.counters().items():
+            counters[(f'{name}_total', ())] = value
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f'# TYPE twidl_{name} counter')
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    label_text = ','.join(f'{label}="{value}"' for label, value in labels)
+                    lines.append(f'twidl_{name}{{{label_text}}} {value}' if labels else f'twidl_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Short plain text overview for /stats."""
+        merged = self.merged()
+        lines = []
+        for stage, (buckets, total) in sorted(merged['histograms'].items()):
+            n = sum(buckets)
+            p95 = self.quantile(buckets, 0.95)
+            lines.append(f'{stage}: {n}x avg {total / n * 1000:.0f}ms p95 '
+                         + (f'<{p95 * 1000:.0f}ms' if p95 != float('inf') else f'>{self.BUCKETS[-1]}s'))
+        counters = merged['counters']
+        hits = {labels: value for (name, labels), value in counters.items() if name == 'cache_hits_total'}
+        misses = {labels: value for (name, labels), value in counters.items() if name == 'cache_misses_total'}
+        rates = dict(merged['caches'])
+        for labels in hits.keys() | misses.keys():
+            rates[dict(labels)['cache']] = (hits.get(labels, 0), misses.get(labels, 0))
+        for name, (hit, miss) in sorted(rates.items()):
+            if hit + miss:
+                lines.append(f'{name} cache: {hit / (hit + miss):.0%} hits of {hit + miss}')
+        errors = {}
+        for (name, labels), value in counters.items():
+            if name == 'upstream_errors_total':
+                errors[dict(labels)['host']] = errors.get(dict(labels)['host'], 0) + value
+        for host, value in sorted(errors.items()):
+            lines.append(f'{host} errors: {value}')
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+def timed(stage: str):
+    """Record the duration of every call of a coroutine function as a stage."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer any HTTP request with the metrics in the Prometheus text format."""
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = metrics.render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+class TTLCache:
+    """LRU cache whose entries expire after a fixed TTL."""
+
+    def __init__(self, maxsize: int, ttl: float, name: Optional[str] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        if name:
+            metrics.caches[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """Lets concurrent calls for the same key share one in-flight operation and its result."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        if (task := self._calls.get(key)) is None:
+            task = self._calls[key] = asyncio.create_task(func())
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            metrics.incr('coalesced_total', operation=self.name)
+        # One caller giving up must not cancel the operation for the others
+        return await asyncio.shield(task)
+
+
+class Store:
+    """SQLite key/value store, counters and token buckets. Every write touches only the rows it changes."""
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes: Dict[str, int] = {}
+        self._takes = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            makedirs(path.dirname(self.filename) or '.', exist_ok=True)
+            # Autocommit: each statement is its own atomic transaction
+            self._db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS kv (namespace TEXT, key TEXT, value BLOB, updated REAL, '
+                             'PRIMARY KEY (namespace, key))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS kv_updated ON kv (namespace, updated)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL, '
+                             'full_at REAL)')
+        return self._db
+
+    def get(self, namespace: str, key: Hashable, default: Any = None) -> Any:
+        row = self.db.execute('SELECT value FROM kv WHERE namespace = ? AND key = ?',
+                              (namespace, str(key))).fetchone()
+        return pickle.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: Hashable, value: Any, maxsize: Optional[int] = None) -> None:
+        """Store a value; with maxsize, the least recently written entries beyond it are evicted."""
+        self.db.execute('INSERT OR REPLACE INTO kv VALUES (?, ?, ?, ?)',
+                        (namespace, str(key), pickle.dumps(value), time.time()))
+        self._writes[namespace] = writes = self._writes.get(namespace, 0) + 1
+        # Evicting is a scan of the namespace, so only do it every so often (per namespace, so each one is trimmed)
+        if maxsize is not None and writes % max(1, min(100, maxsize)) == 0:
+            self.db.execute('DELETE FROM kv WHERE namespace = ? AND key IN (SELECT key FROM kv WHERE namespace = ? '
+                            'ORDER BY updated DESC LIMIT -1 OFFSET ?)', (namespace, namespace, maxsize))
+
+    def delete(self, namespace: str, key: Hashable) -> None:
+        self.db.execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, str(key)))
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        return {key: pickle.loads(value) for key, value in
+                self.db.execute('SELECT key, value FROM kv WHERE namespace = ?', (namespace,))}
+
+    def clear(self, namespace: str) -> None:
+        self.db.execute('DELETE FROM kv WHERE namespace = ?', (namespace,))
+
+    def count(self, namespace: str) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM kv WHERE namespace = ?', (namespace,)).fetchone()[0]
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        """Atomically add to a counter, creating it if needed."""
+        self.db.execute('INSERT INTO counters VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + ?',
+                        (name, amount, amount))
+
+    def counters(self) -> Dict[str, int]:
+        return dict(self.db.execute('SELECT name, value FROM counters'))
+
+    def reset_counters(self) -> None:
+        self.db.execute('UPDATE counters SET value = 0')
+
+    def take(self, bucket: str, rate: float, capacity: float, cost: float = 1) -> float:
+        """Take tokens from a token bucket shared by every process using the store.
+
+        Returns 0 once they are taken, or else the seconds until there are enough, taking nothing."""
+        now = time.time()
+        with self.db:
+            # Immediate, so no other process can take from the bucket between the read and the write
+            self.db.execute('BEGIN IMMEDIATE')
+            row = self.db.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (bucket,)).fetchone()
+            # Full buckets are deleted, so a missing one is full
+            tokens, updated = row or (capacity, now)
+            if now > updated:
+                tokens, updated = min(capacity, tokens + (now - updated) * rate), now
+            if tokens < cost:
+                return updated - now + (cost - tokens) / rate
+            tokens -= cost
+            self.db.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)',
+                            (bucket, tokens, updated, updated + (capacity - tokens) / rate))
+        self._takes += 1
+        if self._takes % 1000 == 0:
+            self.db.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+        return 0.0
+
+    def pause(self, bucket: str, seconds: float, rate: float, capacity: float) -> None:
+        """Empty a shared token bucket and let it refill only after the given time."""
+        resume = time.time() + seconds
+        self.db.execute('INSERT INTO buckets VALUES (?, 0, ?, ?) ON CONFLICT (name) DO UPDATE SET tokens = 0, '
+                        'updated = MAX(updated, excluded.updated), full_at = MAX(updated, excluded.updated) + ?',
+                        (bucket, resume, resume + capacity / rate, capacity / rate))
+
+
+store = Store(DATABASE_PATH)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persist bot, chat and user data in the store, writing only the entries that changed since the last flush."""
+
+    def __init__(self, store: Store, update_interval: float = 60) -> None:
+        super().__init__(store_data=PersistenceInput(), update_interval=update_interval)
+        self.store = store
+        # Pickled value of each stored entry, to skip writing unchanged ones
+        self._written: Dict[Tuple[str, Hashable], bytes] = {}
+
+    def _load(self, namespace: str, key_type: Callable[[str], Hashable] = str) -> dict:
+        data = {}
+        for key, value in self.store.items(namespace).items():
+            data[key_type(key)] = value
+            self._written[(namespace, key_type(key))] = pickle.dumps(value)
+        return data
+
+    def _write(self, namespace: str, key: Hashable, value: Any) -> None:
+        dumped = pickle.dumps(value)
+        if self._written.get((namespace, key)) != dumped:
+            self.store.set(namespace, key, value)
+            self._written[(namespace, key)] = dumped
+
+    def _drop(self, namespace: str, key: Hashable) -> None:
+        self.store.delete(namespace, key)
+        self._written.pop((namespace, key), None)
+
+    async def get_bot_data(self) -> dict:
+        return self._load('bot_data')
+
+    async def update_bot_data(self, data: dict) -> None:
+        for key, value in data.items():
+            self._write('bot_data', key, value)
+        for namespace, key in [k for k in self._written if k[0] == 'bot_data' and k[1] not in data]:
+            self._drop(namespace, key)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return self._load('chat_data', int)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._write('chat_data', chat_id, data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop('chat_data', chat_id)
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return self._load('user_data', int)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._write('user_data', user_id, data)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop('user_data', user_id)
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return self.store.get('callback_data', 'data')
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._write('callback_data', 'data', data)
+
+    async def get_conversations(self, name: str) -> dict:
+        return {tuple(json.loads(key)): state for key, state in self.store.items(f'conversations:{name}').items()}
+
+    async def update_conversation(self, name: str, key: Tuple[Union[int, str], ...], new_state: Optional[object]) -> None:
+        if new_state is None:
+            self._drop(f'conversations:{name}', json.dumps(key))
+        else:
+            self._write(f'conversations:{name}', json.dumps(key), new_state)
+
+    async def flush(self) -> None:
+        pass
+
+
+def migrate_pickle_persistence(filename: str) -> None:
+    """Import stats, file_ids and chat/user data from the old PicklePersistence file, once."""
+    if not path.exists(filename) or store.get('meta', 'migrated'):
+        return
+    try:
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+    except Exception as exc:
+        logger.warning(f'Could not read {filename} for migration: {exc}')
+        return
+    bot_data = data.get('bot_data') or {}
+    for name, value in bot_data.pop('stats', {}).items():
+        store.incr(name, value)
+    for key, file_id in bot_data.pop('file_ids', {}).items():
+        store.set('file_ids', key, file_id)
+    for key, value in bot_data.items():
+        store.set('bot_data', key, value)
+    for namespace in ('chat_data', 'user_data'):
+        for key, value in (data.get(namespace) or {}).items():
+            store.set(namespace, key, value)
+    store.set('meta', 'migrated', True)
+    logger.info(f'Migrated {filename} to {DATABASE_PATH}')
+
+
+class TweetQueue:
+    """Durable SQLite queue of tweets to reply with, holding one job per (chat, tweet) until it is done.
+
+    Workers lease jobs; if a worker dies before finishing one, it is handed out again once the lease runs out.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            makedirs(path.dirname(self.filename) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False, timeout=30)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, '
+                             'tweet_id TEXT, payload TEXT, attempts INTEGER DEFAULT 0, leased_until REAL DEFAULT 0, '
+                             'UNIQUE (chat_id, tweet_id))')
+        return self._db
+
+    def put(self, chat_id: int, tweet_id: str, payload: str) -> bool:
+        """Queue a job, unless the same tweet is already queued for the chat."""
+        return self.db.execute('INSERT OR IGNORE INTO jobs (chat_id, tweet_id, payload) VALUES (?, ?, ?)',
+                               (chat_id, tweet_id, payload)).rowcount == 1
+
+    def claim(self) -> Optional[Tuple[int, str, str, int]]:
+        """Lease the oldest job whose chat has no earlier job, so each chat gets its replies in order."""
+        now = time.time()
+        # A single statement, so two workers can never claim the same job
+        return self.db.execute('UPDATE jobs SET leased_until = ?, attempts = attempts + 1 WHERE id = '
+                               '(SELECT id FROM jobs AS job WHERE leased_until < ? AND NOT EXISTS '
+                               '(SELECT 1 FROM jobs AS earlier WHERE earlier.chat_id = job.chat_id AND earlier.id < job.id) '
+                               'ORDER BY id LIMIT 1) RETURNING id, tweet_id, payload, attempts',
+                               (now + JOB_LEASE, now)).fetchone()
+
+    def renew(self, job_id: int) -> None:
+        self.db.execute('UPDATE jobs SET leased_until = ? WHERE id = ?', (time.time() + JOB_LEASE, job_id))
+
+    def done(self, job_id: int) -> None:
+        self.db.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+
+tweet_queue = TweetQueue(QUEUE_PATH)
+
+
+class TokenBucket:
+    """Token bucket rate limit whose waiters are served in priority order (lower first)."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._seq = count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, priority: int = 0, cost: float = 1) -> None:
+        cost = min(cost, self.capacity)
+        if not self._waiters and self._take(cost):
+            return
+        future = asyncio.get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._seq), cost, future))
+        self._grant()
+        await future
+
+    def is_idle(self) -> bool:
+        """Whether nobody waits and the bucket has refilled, so a new bucket would behave the same."""
+        refilled = self._tokens + max(0.0, time.monotonic() - self._updated) * self.rate
+        return not self._waiters and refilled >= self.capacity
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for the given time, e.g. after Telegram answered with RetryAfter."""
+        self._tokens = 0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+    def _take(self, cost: float) -> bool:
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        if self._tokens >= cost:
+            self._tokens -= cost
+            return True
+        return False
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._grant()
+
+    def _grant(self) -> None:
+        while self._waiters:
+            priority, seq, cost, future = self._waiters[0]
+            if future.cancelled():
+                heappop(self._waiters)
+            elif self._take(cost):
+                heappop(self._waiters)
+                future.set_result(None)
+            else:
+                break
+        if self._waiters and self._timer is None:
+            cost = self._waiters[0][2]
+            delay = max(0.0, self._updated - time.monotonic()) + (cost - self._tokens) / self.rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+
+class SharedTokenBucket:
+    """Token bucket kept in the store, so every process sending to the same chat shares its limit.
+
+    A local bucket in front of it keeps the waiters of this process in priority order."""
+
+    def __init__(self, name: str, rate: float, capacity: float) -> None:
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self._local = TokenBucket(rate, capacity)
+
+    async def acquire(self, priority: int = 0, cost: float = 1) -> None:
+        await self._local.acquire(priority, cost)
+        while wait := store.take(self.name, self.rate, self.capacity, min(cost, self.capacity)):
+            await asyncio.sleep(wait)
+
+    def is_idle(self) -> bool:
+        # The shared state lives in the store, so only local waiters would be lost
+        return self._local.is_idle()
+
+    def pause(self, seconds: float) -> None:
+        self._local.pause(seconds)
+        store.pause(self.name, seconds, self.rate, self.capacity)
+
+
+class SendScheduler(BaseRateLimiter):
+    """Throttle outgoing Bot API sends with global and per-chat token buckets.
+
+    Status messages are let through ahead of media uploads, and sends answered with RetryAfter
+    pause their chat's bucket (or the global one) for the requested time before being retried.
+    With shared, per-chat buckets are kept in the store so the bot and its workers stay under them together.
+    """
+
+    # Lower goes first; methods not listed here are not throttled (getUpdates, getMe, ...)
+    PRIORITIES = {
+        'sendMessage': 0, 'editMessageText': 0, 'deleteMessage': 0, 'answerInlineQuery': 0,
+        'sendPhoto': 1, 'sendDocument': 1, 'sendMediaGroup': 1, 'sendAnimation': 1, 'sendVideo': 1,
+    }
+
+    def __init__(self, share: float = 1, shared: bool = False) -> None:
+        # Processes sending side by side each get a share of the global limit
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE * share, max(1, GLOBAL_SEND_BURST * share))
+        self.shared = shared
+        self._chat_buckets: Dict[Union[int, str], Union[TokenBucket, SharedTokenBucket]] = {}
+        self._prune_at = 1024
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def chat_bucket(self, chat_id: Union[int, str]) -> Union[TokenBucket, SharedTokenBucket]:
+        if chat_id not in self._chat_buckets:
+            if len(self._chat_buckets) >= self._prune_at:
+                # Full, idle buckets hold no state worth keeping; pruning when the dict doubles keeps this cheap
+                for idle_chat_id in [key for key, bucket in self._chat_buckets.items() if bucket.is_idle()]:
+                    del self._chat_buckets[idle_chat_id]
+                self._prune_at = max(1024, 2 * len(self._chat_buckets))
+            # Negative ids are groups and channels, which Telegram limits much harder
+            is_group = str(chat_id).startswith(('-', '@'))
+            rate = GROUP_SEND_RATE if is_group else CHAT_SEND_RATE
+            self._chat_buckets[chat_id] = (SharedTokenBucket(f'chat:{chat_id}', rate, CHAT_SEND_BURST) if self.shared
+                                           else TokenBucket(rate, CHAT_SEND_BURST))
+        return self._chat_buckets[chat_id]
+
+    async def process_request(self, callback: Callable[..., Awaitable[Any]], args: Any, kwargs: Dict[str, Any],
+                              endpoint: str, data: Dict[str, Any], rate_limit_args: Optional[Any]) -> Any:
+        if (priority := self.PRIORITIES.get(endpoint)) is None:
+            return await callback(*args, **kwargs)
+        chat_id = data.get('chat_id')
+        # An album is one message in its chat, but counts once per item towards the global limit
+        cost = len(data.get('media') or ()) or 1
+        max_retries = (rate_limit_args or {}).get('max_retries', SEND_MAX_RETRIES)
+        for attempt in range(max_retries + 1):
+            with metrics.timer('telegram_wait'):
+                if chat_id is not None:
+                    await self.chat_bucket(chat_id).acquire(priority)
+                await self.global_bucket.acquire(priority, cost)
+            try:
+                with metrics.timer(f'telegram_{endpoint}'):
+                    return await callback(*args, **kwargs)
+            except telegram.error.TelegramError as exc:
+                metrics.incr('upstream_errors_total', host=urlsplit(TELEGRAM_API_URL).hostname,
+                             error=exc.__class__.__name__)
+                if not isinstance(exc, RetryAfter):
+                    raise
+                # Pause even when not retrying, so other sends to the chat wait out the flood limit too
+                (self.chat_bucket(chat_id) if chat_id is not None else self.global_bucket).pause(exc.retry_after)
+                if attempt == max_retries:
+                    raise
+                logger.warning(f'Flood limit hit on {endpoint} to {chat_id}, retrying in {exc.retry_after}s')
+
+
+# Replies come from worker processes too when there are any, and they all send to the same chats
+send_scheduler = SendScheduler(shared=JOB_WORKERS > 0)
+
+
+# Normalized provider responses, shared by scrape_media and scrape_tweet_details
+tweet_cache = TTLCache(TWEET_CACHE_SIZE, TWEET_CACHE_TTL, 'tweets')
+
+# Whether the 'orig' quality variant of a photo url exists
+orig_probe_cache = TTLCache(ORIG_PROBE_CACHE_SIZE, ORIG_PROBE_CACHE_TTL, 'orig_probes')
+
+# Responses with these statuses are retried like connection errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """Return the shared client, whose keep-alive connection pool is reused by every request."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+            timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]),
+            follow_redirects=True)
+    return _http_client
+
+
+async def http_request(method: str, url: str, stream: bool = False, follow_redirects: bool = True,
+                       **kwargs) -> httpx.Response:
+    """Send a request through the shared client, retrying transient failures with backoff."""
+    client = http_client()
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            response = await client.send(client.build_request(method, url, **kwargs), stream=stream,
+                                         follow_redirects=follow_redirects)
+        except httpx.TransportError as exc:
+            metrics.incr('upstream_errors_total', host=urlsplit(url).hostname, error=exc.__class__.__name__)
+            if attempt == HTTP_RETRIES:
+                raise
+        else:
+            if response.status_code >= 400:
+                metrics.incr('upstream_errors_total', host=urlsplit(url).hostname, error=response.status_code)
+            if response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                return response
+            await response.aclose()
+        await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+
+async def http_get(url: str, **kwargs) -> httpx.Response:
+    """GET through the shared client with the default timeouts."""
+    return await http_request('GET', url, **kwargs)
+
+
+async def http_head(url: str, **kwargs) -> httpx.Response:
+    """HEAD through the shared client with the default timeouts."""
+    return await http_request('HEAD', url, **kwargs)
+
+
+tco_flights = SingleFlight('tco')
+tweet_flights = SingleFlight('tweet')
+probe_flights = SingleFlight('orig_probe')
+video_flights = SingleFlight('video')
+
+
+# Tweet urls on twitter.com, x.com and their mirrors, including mobile and /i/web/status links
+TWEET_URL_PATTERN = re.compile(r"\b(?:(?:www|mobile)\.)?(?:fx|vx|fixup|fixv)?(?:twitter|x)\.com/"
+                               r"(?:i/web|\w{1,15})/status(?:es)?/([0-9]{1,20})")
+# Tweet urls (group 1) and t.co codes (group 2), found in one pass so they keep their order in the message
+LINK_PATTERN = re.compile(TWEET_URL_PATTERN.pattern + r"|\bt\.co/([a-zA-Z0-9]+)")
+
+
+async def unshorten(link: str) -> str:
+    """Follow a short link's redirects until one points at a tweet, without downloading any page."""
+    url = link
+    with metrics.timer('tco_unshorten'):
+        for _ in range(TCO_MAX_REDIRECTS):
+            response = await http_get(url, stream=True, follow_redirects=False)
+            await response.aclose()
+            if response.is_success:
+                break
+            if not response.is_redirect:
+                # Errors and redirects without a Location are not cached, the next message tries again
+                response.raise_for_status()
+            url = str(response.url.join(response.headers['Location']))
+            if TWEET_URL_PATTERN.search(url):
+                break
+        else:
+            raise httpx.TooManyRedirects(f'No tweet url after {TCO_MAX_REDIRECTS} redirects', request=response.request)
+    # Only final answers are cached: a tweet url or a page that isn't a redirect
+    store.set('tco', link, url, maxsize=TCO_CACHE_SIZE)
+    return url
+
+
+async def resolve_tco(update: Update, code: str) -> Optional[str]:
+    """Return where a t.co link points, remembering every resolved link."""
+    link = f'{TCO_URL}/{code}'
+    if (url := store.get('tco', link)) is not None:
+        metrics.incr('cache_hits_total', cache='tco')
+        return url
+    metrics.incr('cache_misses_total', cache='tco')
+    try:
+        url = await tco_flights.do(link, lambda: unshorten(link))
+    except httpx.HTTPError as exc:
+        log_handling(update, 'info', f'Could not unshorten link [{link}]: {exc.__class__.__qualname__}: {exc}')
+        return None
+    log_handling(update, 'info', f'Unshortened t.co link [{link} -> {url}]')
+    return url
+
+
+@timed('link_extraction')
+async def extract_tweet_ids(update: Update, text: Optional[str] = None) -> Optional[List[str]]:
+    """Extract tweet IDs from message, or from text if given."""
+    matches = [match.groups() for match in LINK_PATTERN.finditer(text or update.effective_message.text)]
+
+    # Resolve every t.co link at once
+    codes = list(dict.fromkeys(code for _, code in matches if code))
+    urls = dict(zip(codes, await asyncio.gather(*(resolve_tco(update, code) for code in codes))))
+
+    tweet_ids = []
+    for tweet_id, code in matches:
+        if code and (match := TWEET_URL_PATTERN.search(urls[code] or '')):
+            tweet_id = match.group(1)
+        if tweet_id:
+            tweet_ids.append(tweet_id)
     tweet_ids = list(dict.fromkeys(tweet_ids))
     return tweet_ids or None
 
 
-def scrape_media(tweet_id: int) -> List[dict]:
-    r = requests.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}')
-    r.raise_for_status()
-    return r.json()['media_extended']
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets one trial request through per cooldown until one succeeds."""
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        # Half open: re-arm so only this request probes the provider until it reports back
+        self.opened_at = time.monotonic()
+        return True
+
+    def record(self, ok: bool) -> bool:
+        """Record a result and return whether the breaker just opened."""
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return False
+        self.failures += 1
+        if self.failures >= self.threshold:
+            was_closed = self.opened_at is None
+            self.opened_at = time.monotonic()
+            return was_closed
+        return False
+
+
+class MetadataProvider:
+    """A tweet metadata API whose responses are normalized to the vxtwitter shape."""
+
+    # Weight of the newest result in the moving averages behind the health score
+    ALPHA = 0.2
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.breaker = CircuitBreaker(PROVIDER_FAILURE_THRESHOLD, PROVIDER_COOLDOWN)
+        # None until the provider has answered at least once
+        self.latency: Optional[float] = None
+        self.success_rate = 1.0
+
+    @property
+    def score(self) -> float:
+        """Expected seconds to a good answer; lower is healthier. Only meaningful once latency is measured."""
+        return self.latency / max(self.success_rate, 0.05)
+
+    def url(self, tweet_id: int) -> str:
+        raise NotImplementedError
+
+    def normalize(self, data: dict) -> dict:
+        return data
+
+    def record(self, ok: bool, seconds: float) -> None:
+        self.success_rate += self.ALPHA * (ok - self.success_rate)
+        # Failures are timed too until there is a first sample, so a provider that only fails still gets ranked
+        if ok or self.latency is None:
+            self.observe_latency(seconds)
+        if self.breaker.record(ok):
+            logger.warning(f'Metadata provider {self.name} keeps failing, skipping it for {PROVIDER_COOLDOWN}s')
+
+    def observe_latency(self, seconds: float) -> None:
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.ALPHA * (seconds - self.latency)
+
+    async def fetch(self, tweet_id: int) -> dict:
+        started = time.monotonic()
+        try:
+            with metrics.timer(f'metadata_{self.name}'):
+                r = await http_get(self.url(tweet_id))
+            r.raise_for_status()
+            data = self.normalize(r.json())
+        except asyncio.CancelledError:
+            # Lost a hedged race: it was at least this slow, which should count against it
+            self.observe_latency(time.monotonic() - started)
+            raise
+        except httpx.HTTPStatusError as exc:
+            # A missing tweet is a correct answer, not a sign of an unhealthy provider
+            self.record(exc.response.status_code == 404, time.monotonic() - started)
+            raise
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+        return data
+
+
+class VxTwitterProvider(MetadataProvider):
+    def url(self, tweet_id: int) -> str:
+        return f'{VXTWITTER_API_URL}/Twitter/status/{tweet_id}'
+
+
+class FxTwitterProvider(MetadataProvider):
+    MEDIA_TYPES = {'photo': 'image', 'video': 'video', 'gif': 'gif'}
+
+    def url(self, tweet_id: int) -> str:
+        return f'{FXTWITTER_API_URL}/status/{tweet_id}'
+
+    def normalize(self, data: dict) -> dict:
+        tweet = data['tweet']
+        return {
+            'text': tweet.get('text', ''),
+            'tweetID': tweet['id'],
+            'tweetURL': tweet['url'],
+            'user_name': tweet['author']['name'],
+            'user_screen_name': tweet['author']['screen_name'],
+            'media_extended': [{'type': self.MEDIA_TYPES.get(media['type'], media['type']), 'url': media['url'],
+                                'thumbnail_url': media.get('thumbnail_url', media['url'])}
+                               for media in (tweet.get('media') or {}).get('all', [])],
+        }
+
 
+PROVIDER_TYPES = {'vxtwitter': VxTwitterProvider, 'fxtwitter': FxTwitterProvider}
+metadata_providers = [PROVIDER_TYPES[name](name) for name in METADATA_PROVIDERS]
 
-def reply_media(update: Update, context: CallbackContext, tweet_media: list, tweet_id: int) -> bool:
+
+def is_not_found(exc: BaseException) -> bool:
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 404
+
+
+def next_allowed_provider(waiting: List[MetadataProvider]) -> Optional[MetadataProvider]:
+    """Take the next provider whose breaker lets a request through.
+
+    Breakers are only asked right before their provider is, since asking a half-open one re-arms it.
+    """
+    while waiting:
+        provider = waiting.pop(0)
+        if provider.breaker.allow():
+            return provider
+    return None
+
+
+async def fetch_from_providers(tweet_id: int) -> dict:
+    """Ask the healthiest provider, hedging to the next one whenever the answer is slow or an error."""
+    if all(provider.latency is not None for provider in metadata_providers):
+        # Stable, so providers keep their configured order until their health scores differ
+        providers = sorted(metadata_providers, key=lambda provider: provider.score)
+    else:
+        # An unmeasured provider has nothing to be ranked by yet
+        providers = list(metadata_providers)
+    waiting = list(providers)
+    # Nothing allowed: still ask the best one rather than fail without trying
+    provider = next_allowed_provider(waiting) or providers[0]
+    pending = set()
+    error: Optional[BaseException] = None
+    try:
+        while provider is not None:
+            pending.add(asyncio.create_task(provider.fetch(tweet_id)))
+            provider = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=METADATA_HEDGE_DELAY if waiting else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    if is_not_found(error):
+                        raise error
+                # Slow or failed: bring in the next provider while the others keep going
+                if provider := next_allowed_provider(waiting):
+                    metrics.incr('metadata_hedges_total', provider=provider.name)
+                    break
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_tweet(tweet_id: int) -> dict:
+    """Fetch tweet metadata from the metadata providers, served from cache when possible."""
+    if (data := tweet_cache.get(tweet_id)) is not None:
+        return data
+    return await tweet_flights.do(tweet_id, lambda: fetch_and_cache_tweet(tweet_id))
+
+
+async def fetch_and_cache_tweet(tweet_id: int) -> dict:
+    with metrics.timer('metadata_fetch'):
+        data = await fetch_from_providers(tweet_id)
+    tweet_cache.set(tweet_id, data)
+    return data
+
+
+async def scrape_media(tweet_id: int) -> List[dict]:
+    return (await fetch_tweet(tweet_id))['media_extended']
+
+
+# Global and per-chat limits on tweets being prepared at once
+tweet_slots = asyncio.Semaphore(MAX_CONCURRENT_TWEETS)
+# chat_id -> (semaphore, number of tasks holding or waiting for it)
+_chat_slots: Dict[int, Tuple[asyncio.Semaphore, int]] = {}
+
+
+@asynccontextmanager
+async def chat_slots(chat_id: int):
+    """Hold one of the slots limiting how many tweets of one chat are prepared at once."""
+    semaphore, users = _chat_slots.get(chat_id) or (asyncio.Semaphore(MAX_CONCURRENT_TWEETS_PER_CHAT), 0)
+    _chat_slots[chat_id] = (semaphore, users + 1)
+    try:
+        async with semaphore:
+            yield
+    finally:
+        semaphore, users = _chat_slots[chat_id]
+        # Dropped once idle, so chats seen once don't stay around forever
+        if users == 1:
+            del _chat_slots[chat_id]
+        else:
+            _chat_slots[chat_id] = (semaphore, users - 1)
+
+
+async def prepare_tweet(update: Update, tweet_id: int) -> Tuple[List[dict], dict, List[str]]:
+    """Fetch everything needed to reply with a tweet: media, caption details and photo urls."""
+    async with chat_slots(update.effective_chat.id), tweet_slots:
+        return await scrape_tweet(update, tweet_id)
+
+
+async def scrape_tweet(update: Update, tweet_id: int) -> Tuple[List[dict], dict, List[str]]:
+    log_handling(update, 'info', f'Scraping tweet ID {tweet_id}')
+    media = await scrape_media(tweet_id)
+    if not media:
+        return media, {}, []
+    tweet_details = await scrape_tweet_details(tweet_id)
+    photo_urls = await resolve_photo_urls(update, [item for item in media if item["type"] == "image"])
+    remember_inline_media(tweet_id, media, tweet_details, photo_urls)
+    return media, tweet_details, photo_urls
+
+
+def remember_inline_media(tweet_id: int, media: List[dict], tweet_details: dict, photo_urls: List[str]) -> None:
+    """Keep what inline results of a tweet are built from, so inline queries don't wait on any upstream."""
+    photo_urls = iter(photo_urls)
+    store.set('inline', tweet_id, {
+        'details': tweet_details,
+        'media': [(item['type'], next(photo_urls) if item['type'] == 'image' else item['url'],
+                   item.get('thumbnail_url', item['url'])) for item in media],
+    }, maxsize=INLINE_CACHE_SIZE)
+
+
+async def reply_media(update: Update, context: ContextTypes.DEFAULT_TYPE, tweet_media: list, tweet_details: dict,
+                      photo_urls: List[str], tweet_id: int) -> bool:
     """Reply to message with supported media."""
-    tweet_details = scrape_tweet_details(tweet_id)
     photos = [media for media in tweet_media if media["type"] == "image"]
     gifs = [media for media in tweet_media if media["type"] == "gif"]
     videos = [media for media in tweet_media if media["type"] == "video"]
     if photos:
-        reply_photos(update, context, photos, tweet_details, tweet_id)
+        await reply_photos(update, context, photo_urls, tweet_details, tweet_id,
+                           fallback_urls=[photo['url'] for photo in photos])
     if gifs:
-        reply_gifs(update, context, gifs, tweet_details, tweet_id)
+        await reply_gifs(update, context, gifs, tweet_details, tweet_id)
     elif videos:
-        reply_videos(update, context, videos, tweet_details, tweet_id)
+        await reply_videos(update, context, videos, tweet_details, tweet_id)
     return bool(photos or gifs or videos)
 
 
-def scrape_tweet_details(tweet_id: int) -> dict:
-    r = requests.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}')
-    r.raise_for_status()
-    data = r.json()
+async def scrape_tweet_details(tweet_id: int) -> dict:
+    data = await fetch_tweet(tweet_id)
 
     return {
         'text': data.get('text', 'NO CONTENT'),
@@ -88,6 +1064,11 @@ def escape_markdown_v2(text: str) -> str:
     return ''.join(['\\' + char if char in characters_to_escape else char for char in text])
 
 
+def escape_markdown_v2_code(text: str) -> str:
+    """Escapes text for use inside a Markdown V2 code block."""
+    return text.replace('\\', '\\\\').replace('`', '\\`')
+
+
 def remove_tco_links(text: str) -> str:
     """Removes t.co links from a given text."""   
     pattern = r"https?://t.co/[a-zA-Z0-9]+"
@@ -124,120 +1105,511 @@ def generate_plain_caption(tweet_details: dict) -> str:
     return caption
 
 
-def reply_photos(update: Update, context: CallbackContext, twitter_photos: List[dict], tweet_details: dict, tweet_id: int) -> None:
-    """Reply with photo group."""
-    photo_group = []
-    doc_group = []
-    tweet_details = scrape_tweet_details(tweet_id)    
-    if len(twitter_photos) == 1:
-        caption = generate_markdown_caption(tweet_details)
+def cached_file_id(url: str, variant: str) -> Optional[str]:
+    """Return the Telegram file_id recorded for a media url sent as the given variant."""
+    file_id = store.get('file_ids', f'{variant}:{url}')
+    metrics.incr('cache_hits_total' if file_id else 'cache_misses_total', cache='file_ids')
+    return file_id
+
+
+def remember_file_id(url: str, variant: str, message: Message) -> None:
+    """Record the file_id Telegram assigned to media sent from url."""
+    if variant == 'photo':
+        file_id = message.photo[-1].file_id if message.photo else None
     else:
-        caption = generate_plain_caption(tweet_details)
-    for photo in twitter_photos:
-        photo_url = photo['url']      
-        parsed_url = urlsplit(photo_url)
-        # Try changing requested quality to 'orig'
+        media = getattr(message, variant, None)
+        file_id = media.file_id if media else None
+    if file_id:
+        store.set('file_ids', f'{variant}:{url}', file_id, maxsize=FILE_ID_CACHE_SIZE)
+
+
+def forget_file_id(url: str, variant: str) -> None:
+    """Drop a file_id Telegram no longer accepts."""
+    store.delete('file_ids', f'{variant}:{url}')
+
+
+async def send_media_cached(context: ContextTypes.DEFAULT_TYPE, variant: str, url: str,
+                            send: Callable[[str], Awaitable[Message]]) -> Message:
+    """Send media by its cached file_id, falling back to the url when the id is unknown or stale."""
+    if file_id := cached_file_id(url, variant):
+        try:
+            return await send(file_id)
+        except BadRequest as exc:
+            logger.info(f'Cached {variant} file_id for {url} was rejected ({exc.message}), sending url')
+            forget_file_id(url, variant)
+    message = await send(url)
+    remember_file_id(url, variant, message)
+    return message
+
+
+async def send_media_group_cached(context: ContextTypes.DEFAULT_TYPE, variant: str, urls: List[str],
+                                  build: Callable[[int, str], Any]) -> List[Message]:
+    """Send a media group using cached file_ids where known, falling back to the urls if any id is stale."""
+    file_ids = [cached_file_id(url, variant) for url in urls]
+    if any(file_ids):
         try:
-            new_url = parsed_url._replace(query='format=jpg&name=orig').geturl()
-            log_handling(update, 'info', 'New photo url: ' + new_url)
-            requests.head(new_url).raise_for_status()
-            doc_group.append(InputMediaDocument(media=new_url))
-            photo_group.append(InputMediaPhoto(media=new_url))
-        except requests.HTTPError:
+            messages = await context.bot.send_media_group(
+                chat_id=DEVELOPER_ID, media=[build(i, file_id or url) for i, (url, file_id) in enumerate(zip(urls, file_ids))])
+            for url, file_id, message in zip(urls, file_ids, messages):
+                if not file_id:
+                    remember_file_id(url, variant, message)
+            return messages
+        except BadRequest as exc:
+            logger.info(f'Cached {variant} file_ids were rejected ({exc.message}), sending urls')
+            for url in urls:
+                forget_file_id(url, variant)
+    messages = await context.bot.send_media_group(chat_id=DEVELOPER_ID, media=[build(i, url) for i, url in enumerate(urls)])
+    for url, message in zip(urls, messages):
+        remember_file_id(url, variant, message)
+    return messages
+
+
+probe_slots = asyncio.Semaphore(MAX_CONCURRENT_PROBES)
+
+
+async def orig_available(url: str) -> bool:
+    """Check whether an 'orig' quality photo url exists, memoizing the answer."""
+    if (available := orig_probe_cache.get(url)) is not None:
+        return available
+    return await probe_flights.do(url, lambda: probe_orig(url))
+
+
+async def probe_orig(url: str) -> bool:
+    async with probe_slots:
+        try:
+            with metrics.timer('orig_probe'):
+                response = await http_head(url)
+        except httpx.TransportError:
+            # Don't remember transient failures (timeouts, refused connections, ...)
+            return False
+    if response.is_success:
+        available = True
+    elif response.status_code in (403, 404):
+        available = False
+    else:
+        # Still failing after retries (5xx, 429): use the original url this time, but ask again next time
+        return False
+    orig_probe_cache.set(url, available)
+    return available
+
+
+async def resolve_photo_urls(update: Update, twitter_photos: List[dict]) -> List[str]:
+    """Return the url to send for each photo, preferring 'orig' quality when available."""
+    # Try changing requested quality to 'orig'
+    orig_urls = [urlsplit(photo['url'])._replace(query='format=jpg&name=orig').geturl() for photo in twitter_photos]
+    if not PROBE_ORIG_PHOTOS:
+        # Let a failed send fall back to the original urls instead
+        return orig_urls
+    photo_urls = []
+    probes = await asyncio.gather(*(orig_available(url) for url in orig_urls))
+    for photo, orig_url, available in zip(twitter_photos, orig_urls, probes):
+        if available:
+            log_handling(update, 'info', 'New photo url: ' + orig_url)
+            photo_urls.append(orig_url)
+        else:
             log_handling(update, 'info', 'orig quality not available, using original url')
-            doc_group.append(InputMediaDocument(media=photo_url))
-            photo_group.append(InputMediaPhoto(media=photo_url))
-    if len(twitter_photos) == 1:        
-        if doc_group:
-            single_document = doc_group[0]
-            single_document.caption = caption
-            single_document.parse_mode = ParseMode.MARKDOWN_V2
-            context.bot.send_document(chat_id=DEVELOPER_ID, document=single_document.media, 
-                caption=single_document.caption, 
-                parse_mode=single_document.parse_mode)
-        if photo_group:
-            single_photo = photo_group[0]
-            single_photo.caption = caption
-            single_photo.parse_mode = ParseMode.MARKDOWN_V2
-            context.bot.send_photo(chat_id=DEVELOPER_ID, photo=single_photo.media, 
-                caption=single_photo.caption,
-                parse_mode=single_photo.parse_mode)
-    else :
-        if doc_group:
-            doc_group[-1].caption = caption
-            context.bot.send_media_group(chat_id=DEVELOPER_ID, media=doc_group)
-        if photo_group:
-            photo_group[0].caption = caption
-            context.bot.send_media_group(chat_id=DEVELOPER_ID, media=photo_group)
-    context.bot_data.setdefault('stats', {}).setdefault('media_downloaded', 0)
-    context.bot_data['stats']['media_downloaded'] += len(doc_group) + len(photo_group)
+            photo_urls.append(photo['url'])
+    return photo_urls
+
+
+async def reply_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_urls: List[str], tweet_details: dict,
+                       tweet_id: int, fallback_urls: Optional[List[str]] = None) -> None:
+    """Reply with photo group, resending with fallback_urls if Telegram rejects photo_urls."""
+    if len(photo_urls) == 1:
+        caption = generate_markdown_caption(tweet_details)
+    else:
+        caption = generate_plain_caption(tweet_details)
+
+    async def send(urls: List[str]) -> None:
+        if len(urls) == 1:
+            await send_media_cached(context, 'document', urls[0], lambda media: context.bot.send_document(
+                chat_id=DEVELOPER_ID, document=media, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
+            await send_media_cached(context, 'photo', urls[0], lambda media: context.bot.send_photo(
+                chat_id=DEVELOPER_ID, photo=media, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
+        else :
+            last = len(urls) - 1
+            await send_media_group_cached(context, 'document', urls, lambda i, media: InputMediaDocument(
+                media=media, caption=caption if i == last else None))
+            await send_media_group_cached(context, 'photo', urls, lambda i, media: InputMediaPhoto(
+                media=media, caption=caption if i == 0 else None))
+
+    try:
+        await send(photo_urls)
+    except BadRequest as exc:
+        if not fallback_urls or fallback_urls == photo_urls:
+            raise
+        log_handling(update, 'info', f'Sending photos failed ({exc.message}), using original urls')
+        await send(fallback_urls)
+    store.incr('media_downloaded', 2 * len(photo_urls))
     log_handling(update, 'info', 'Finished sending photo groups.')
 
 
-def reply_gifs(update: Update, context: CallbackContext, twitter_gifs: List[dict], tweet_details: dict, tweet_id: int):
+async def reply_gifs(update: Update, context: ContextTypes.DEFAULT_TYPE, twitter_gifs: List[dict], tweet_details: dict,
+                     tweet_id: int):
     """Reply with GIF animations."""
-    tweet_details = scrape_tweet_details(tweet_id)
     caption = generate_markdown_caption(tweet_details)
     for gif in twitter_gifs:
         gif_url = gif['url']
         log_handling(update, 'info', f'Gif url: {gif_url}')
-        context.bot.send_animation(chat_id=DEVELOPER_ID, animation=gif_url, caption=caption, parse_mode=telegram.ParseMode.MARKDOWN_V2)
+        await send_media_cached(context, 'animation', gif_url, lambda media: context.bot.send_animation(
+            chat_id=DEVELOPER_ID, animation=media, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
         log_handling(update, 'info', 'Sent gif')
-        context.bot_data['stats']['media_downloaded'] += 1
+        store.incr('media_downloaded')
+
+
+# Oversized videos are transferred through these slots so they can't starve small replies
+large_transfer_slots = asyncio.Semaphore(MAX_CONCURRENT_LARGE_TRANSFERS)
+
 
+class TransferProgress:
+    """Show transfer progress on a status message, editing it at most once per PROGRESS_INTERVAL."""
 
-def reply_videos(update: Update, context: CallbackContext, twitter_videos: List[dict], tweet_details: dict, tweet_id: int):
+    def __init__(self, message: Message, total: int) -> None:
+        self.message = message
+        self.text = message.text
+        self.total = total
+        self._last_edit = time.monotonic()
+
+    async def update(self, done: int) -> None:
+        if time.monotonic() - self._last_edit < PROGRESS_INTERVAL:
+            return
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(f'{self.text}\n{done * 100 // self.total}% '
+                                         f'({done // 1048576}/{self.total // 1048576} MB)')
+        except telegram.error.TelegramError as exc:
+            logger.info(f'Could not update progress message: {exc}')
+
+
+class MediaCache:
+    """Media files stored by content hash, capped in total size and evicting the least recently used first.
+
+    The cap holds for the directory as a whole, so every process sharing it stays under it together."""
+
+    TMP_PREFIX = '.tmp'
+
+    def __init__(self, directory: str, maxsize: int) -> None:
+        self.directory = directory
+        self.maxsize = maxsize
+
+    def get(self, url: str) -> Optional[str]:
+        """Return the file holding the media of a url, marking it as recently used."""
+        digest = store.get('media', url)
+        if digest is None or not path.exists(filename := path.join(self.directory, digest)):
+            metrics.incr('cache_misses_total', cache='media')
+            return None
+        # Files are evicted in order of their mtime
+        utime(filename)
+        metrics.incr('cache_hits_total', cache='media')
+        return filename
+
+    @asynccontextmanager
+    async def spool(self) -> AsyncIterator[str]:
+        """Name a temp file for one transfer, removed once the transfer is done whatever the cache keeps."""
+        makedirs(self.directory, exist_ok=True)
+        spooled = path.join(self.directory, f'{self.TMP_PREFIX}{uuid4().hex}')
+        try:
+            yield spooled
+        finally:
+            if path.exists(spooled):
+                remove(spooled)
+
+    def pin(self, url: str, spooled: str) -> bool:
+        """Link the cached media of a url to a spooled file, so eviction can't take it away mid-transfer."""
+        if (digest := store.get('media', url)) is None:
+            return False
+        try:
+            link(path.join(self.directory, digest), spooled)
+        except FileNotFoundError:
+            # Evicted by another process since
+            return False
+        return True
+
+    async def tee(self, url: str, chunks: AsyncIterable[bytes], size: int, spooled: str) -> AsyncIterator[bytes]:
+        """Pass chunks through while writing them to spooled, which is cached once all size bytes arrived.
+
+        spooled only exists afterwards if the download was complete."""
+        digest = hashlib.sha256()
+        written = 0
+        try:
+            with open(spooled, 'xb') as f:
+                async for chunk in chunks:
+                    # Off the event loop, so a slow disk doesn't hold up every other chat
+                    await asyncio.to_thread(self._write, f, digest, chunk)
+                    written += len(chunk)
+                    yield chunk
+                if written != size:
+                    raise IOError(f'Media download ended after {written} of {size} bytes')
+                await asyncio.to_thread(self._sync, f)
+        except BaseException:
+            if path.exists(spooled):
+                remove(spooled)
+            raise
+        await asyncio.to_thread(self._keep, url, spooled, digest.hexdigest())
+
+    @staticmethod
+    def _write(f, digest, chunk: bytes) -> None:
+        f.write(chunk)
+        digest.update(chunk)
+
+    @staticmethod
+    def _sync(f) -> None:
+        f.flush()
+        fsync(f.fileno())
+
+    def _keep(self, url: str, spooled: str, digest: str) -> None:
+        filename = path.join(self.directory, digest)
+        try:
+            # A hard link is atomic, so a crash never leaves a partial file under a content hash,
+            # and spooled stays readable for the upload even if the cache evicts its copy
+            link(spooled, filename)
+        except FileExistsError:
+            # Same content already cached under another url
+            utime(filename)
+        store.set('media', url, digest)
+        self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        for entry in scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if not entry.name.startswith(self.TMP_PREFIX):
+                    files.append((stat.st_mtime, stat.st_size, entry))
+                elif time.time() - stat.st_mtime > UPLOAD_TIMEOUT:
+                    # Left over from a transfer that never finished; live ones are touched before every upload
+                    remove(entry.path)
+            except FileNotFoundError:
+                # Removed by another process meanwhile
+                pass
+        size = sum(file_size for _, file_size, _ in files)
+        if size <= self.maxsize:
+            return
+        evicted = set()
+        for _, file_size, entry in sorted(files, key=lambda file: file[0]):
+            if size <= self.maxsize:
+                break
+            size -= file_size
+            try:
+                remove(entry.path)
+            except FileNotFoundError:
+                pass
+            evicted.add(entry.name)
+        for url, digest in store.items('media').items():
+            if digest in evicted:
+                store.delete('media', url)
+
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE)
+
+
+async def read_mapped(filename: str) -> AsyncIterator[bytes]:
+    """Read a file in chunks through a memory map, without read calls or a buffer of its own."""
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for offset in range(0, len(mapped), LARGE_VIDEO_CHUNK_SIZE):
+            yield mapped[offset:offset + LARGE_VIDEO_CHUNK_SIZE]
+
+
+class MultipartStream:
+    """multipart/form-data request body whose file part is read from `source` while it is being uploaded."""
+
+    def __init__(self, fields: dict, name: str, filename: str, content_type: str, source: AsyncIterable[bytes],
+                 size: int, progress: Optional[TransferProgress] = None) -> None:
+        boundary = uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        head = ''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+                       for key, value in fields.items())
+        head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n')
+        self._head = head.encode()
+        self._tail = f'\r\n--{boundary}--\r\n'.encode()
+        self._source = source
+        self._size = size
+        self._progress = progress
+
+    def __len__(self) -> int:
+        return len(self._head) + self._size + len(self._tail)
+
+    async def __aiter__(self):
+        yield self._head
+        sent = 0
+        async for chunk in self._source:
+            sent += len(chunk)
+            if self._progress:
+                await self._progress.update(sent)
+            yield chunk
+        if sent != self._size:
+            raise IOError(f'Video stream ended after {sent} of {self._size} bytes')
+        yield self._tail
+
+
+async def post_multipart(context: ContextTypes.DEFAULT_TYPE, method: str, body: MultipartStream,
+                         chat_id: Union[int, str]) -> Message:
+    """Call a Bot API method with a streamed multipart body, going through the send scheduler."""
+    async def post() -> Message:
+        response = await http_client().post(f'{context.bot.base_url}/{method}', content=body,
+                                            headers={'Content-Type': body.content_type, 'Content-Length': str(len(body))},
+                                            timeout=httpx.Timeout(UPLOAD_TIMEOUT, connect=HTTP_TIMEOUT[0]))
+        result = response.json()
+        if not result.get('ok'):
+            if retry_after := result.get('parameters', {}).get('retry_after'):
+                raise RetryAfter(retry_after)
+            raise telegram.error.BadRequest(result.get('description', f'{method} failed ({response.status_code})'))
+        return Message.de_json(result['result'], context.bot)
+
+    # The body can only be streamed once, so a flood limit answer is not retried here
+    return await send_scheduler.process_request(post, (), {}, method, {'chat_id': chat_id}, {'max_retries': 0})
+
+
+async def upload_large_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_url: str, video_size: int,
+                             caption: str, cached: bool = False) -> Message:
+    """Upload a video too big to be sent by url from a downloaded file, taken from the media cache if cached.
+
+    With STREAM_LARGE_VIDEOS the download is uploaded while it arrives instead, and kept on the way."""
+    status = await update.effective_message.reply_text(
+        '視頻太大，無法直接下載\n使用上傳方法 '
+        '(這可能要花一點時間)',
+        quote=True)
+    progress = TransferProgress(status, video_size)
+    fields = {'chat_id': DEVELOPER_ID, 'caption': caption, 'parse_mode': ParseMode.MARKDOWN_V2,
+              'supports_streaming': 'true'}
+    try:
+        async with large_transfer_slots, media_cache.spool() as spooled:
+            if cached and media_cache.pin(video_url, spooled):
+                log_handling(update, 'info', 'Uploading video from the media cache')
+            else:
+                # Opened only once a slot is free, so waiting transfers don't hold idle twimg connections
+                request = await http_get(video_url, stream=True)
+                try:
+                    request.raise_for_status()
+                    if STREAM_LARGE_VIDEOS:
+                        log_handling(update, 'info', f'Streaming video to Telegram (Content-length: {video_size})')
+                        source = media_cache.tee(video_url, request.aiter_bytes(chunk_size=LARGE_VIDEO_CHUNK_SIZE),
+                                                 video_size, spooled)
+                        body = MultipartStream(fields, 'video', 'video.mp4',
+                                               request.headers.get('Content-Type', 'video/mp4'), source, video_size,
+                                               progress)
+                        try:
+                            with metrics.timer('video_stream_upload'):
+                                return await post_multipart(context, 'sendVideo', body, DEVELOPER_ID)
+                        except RetryAfter:
+                            # The stream can't be replayed, but it was kept on the way if it was read to the end
+                            await source.aclose()
+                            if not path.exists(spooled):
+                                raise
+                            log_handling(update, 'info', 'Flood limit hit, retrying the upload from the downloaded file')
+                    else:
+                        log_handling(update, 'info', f'Downloading video (Content-length: {video_size})')
+                        downloaded = 0
+                        with metrics.timer('video_download'):
+                            async for chunk in media_cache.tee(
+                                    video_url, request.aiter_bytes(chunk_size=LARGE_VIDEO_CHUNK_SIZE), video_size,
+                                    spooled):
+                                downloaded += len(chunk)
+                                await progress.update(downloaded)
+                        log_handling(update, 'info', 'Video downloaded, uploading to Telegram')
+                finally:
+                    await request.aclose()
+            for attempt in range(SEND_MAX_RETRIES + 1):
+                # Touched so it isn't taken for a leftover of a crashed transfer while it is being uploaded
+                utime(spooled)
+                # A file body can be rebuilt, so unlike a stream it is retried after a flood limit
+                body = MultipartStream(fields, 'video', 'video.mp4', 'video/mp4', read_mapped(spooled), video_size,
+                                       TransferProgress(status, video_size))
+                try:
+                    with metrics.timer('video_upload'):
+                        return await post_multipart(context, 'sendVideo', body, DEVELOPER_ID)
+                except RetryAfter:
+                    if attempt == SEND_MAX_RETRIES:
+                        raise
+                    # The send scheduler has paused the chat, so the next attempt waits out the limit
+                    log_handling(update, 'info', 'Flood limit hit, retrying the upload from the downloaded file')
+    finally:
+        try:
+            await status.delete()
+        except telegram.error.TelegramError as exc:
+            log_handling(update, 'info', f'Could not delete upload status message: {exc}')
+
+
+async def transfer_video(update: Update, context: ContextTypes.DEFAULT_TYPE, video_url: str,
+                         caption: str) -> Optional[Message]:
+    """Send a video by url, or upload it if Telegram can't fetch it itself. Returns None if it is too large."""
+    if (filename := media_cache.get(video_url)) is not None:
+        # Downloaded before, so its file_id was lost or its upload failed
+        sent = await upload_large_video(update, context, video_url, path.getsize(filename), caption, cached=True)
+        remember_file_id(video_url, 'video', sent)
+        log_handling(update, 'info', 'Sent video (upload)')
+        return sent
+    request = await http_get(video_url, stream=True)
+    try:
+        request.raise_for_status()
+        if (video_size := int(request.headers['Content-Length'])) <= constants.FileSizeLimit.FILESIZE_DOWNLOAD:
+            # Try sending by url
+            sent = await context.bot.send_video(chat_id=DEVELOPER_ID, video=video_url, caption=caption, parse_mode=ParseMode.MARKDOWN_V2, supports_streaming=True)
+            remember_file_id(video_url, 'video', sent)
+            log_handling(update, 'info', 'Sent video (download)')
+        elif video_size <= constants.FileSizeLimit.FILESIZE_UPLOAD:
+            log_handling(update, 'info', f'Video size ({video_size}) is bigger than '
+                                        f'MAX_FILESIZE_UPLOAD, using upload method')
+            # Only the size was needed; the upload downloads the video once it gets a transfer slot
+            await request.aclose()
+            sent = await upload_large_video(update, context, video_url, video_size, caption)
+            remember_file_id(video_url, 'video', sent)
+            log_handling(update, 'info', 'Sent video (upload)')
+        else:
+            return None
+        return sent
+    finally:
+        await request.aclose()
+
+
+async def reply_videos(update: Update, context: ContextTypes.DEFAULT_TYPE, twitter_videos: List[dict],
+                       tweet_details: dict, tweet_id: int):
     """Reply with videos."""
-    tweet_details = scrape_tweet_details(tweet_id)
     caption = generate_markdown_caption(tweet_details)
     for video in twitter_videos:
         video_url = video['url']
+        if file_id := cached_file_id(video_url, 'video'):
+            try:
+                await context.bot.send_video(chat_id=DEVELOPER_ID, video=file_id, caption=caption, parse_mode=ParseMode.MARKDOWN_V2, supports_streaming=True)
+                log_handling(update, 'info', 'Sent video (cached file_id)')
+                store.incr('media_downloaded')
+                continue
+            except telegram.error.BadRequest as exc:
+                log_handling(update, 'info', f'Cached video file_id was rejected ({exc.message}), resending')
+                forget_file_id(video_url, 'video')
         try:
-            request = requests.get(video_url, stream=True)
-            request.raise_for_status()
-            if (video_size := int(request.headers['Content-Length'])) <= constants.MAX_FILESIZE_DOWNLOAD:
-                # Try sending by url
-                context.bot.send_video(chat_id=DEVELOPER_ID, video=video_url, caption=caption, parse_mode=telegram.ParseMode.MARKDOWN_V2, supports_streaming=True)
-                log_handling(update, 'info', 'Sent video (download)')
-            elif video_size <= constants.MAX_FILESIZE_UPLOAD:
-                log_handling(update, 'info', f'Video size ({video_size}) is bigger than '
-                                            f'MAX_FILESIZE_UPLOAD, using upload method')
-                message = update.effective_message.reply_text(
-                    '視頻太大，無法直接下載\n使用上傳方法 '
-                    '(這可能要花一點時間)',
-                    quote=True)
-                with TemporaryFile() as tf:
-                    log_handling(update, 'info', f'Downloading video (Content-length: '
-                                                f'{request.headers["Content-length"]})')
-                    for chunk in request.iter_content(chunk_size=128):
-                        tf.write(chunk)
-                    log_handling(update, 'info', 'Video downloaded, uploading to Telegram')
-                    tf.seek(0)
-                    context.bot.send_video(chat_id=DEVELOPER_ID, video=tf, caption=caption, parse_mode=telegram.ParseMode.MARKDOWN_V2, supports_streaming=True)
-                    log_handling(update, 'info', 'Sent video (upload)')
-                message.delete()
-            else:
+            # Chats asking for the same video at once share one transfer
+            shared = video_url in video_flights
+            sent = await video_flights.do(video_url, lambda: transfer_video(update, context, video_url, caption))
+            if sent is None:
                 log_handling(update, 'info', 'Video is too large, sending direct link')
-                update.effective_message.reply_text(f'{caption}\n\n視頻太大，無法上傳至 Telegram。視頻直鏈:\n'
-                                        f'{video_url}', quote=True)
-        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError) as exc:
+                await update.effective_message.reply_text(f'{caption}\n\n視頻太大，無法上傳至 Telegram。視頻直鏈:\n'
+                                                          f'{video_url}', quote=True)
+            elif shared:
+                await context.bot.send_video(chat_id=DEVELOPER_ID, video=sent.video.file_id, caption=caption, parse_mode=ParseMode.MARKDOWN_V2, supports_streaming=True)
+                log_handling(update, 'info', 'Sent video (shared transfer)')
+        except (httpx.HTTPError, KeyError, telegram.error.TelegramError, IOError) as exc:
             log_handling(update, 'info', f'{exc.__class__.__qualname__}: {exc}')
             log_handling(update, 'info', 'Error occurred when trying to send video, sending direct link')
-            update.effective_message.reply_text(f'嘗試發送視頻時出現錯誤，直鏈:\n'
-                                    f'{video_url}', quote=True)
-        context.bot_data['stats']['media_downloaded'] += 1
+            await update.effective_message.reply_text(f'嘗試發送視頻時出現錯誤，直鏈:\n'
+                                                      f'{video_url}', quote=True)
+        store.incr('media_downloaded')
 
 
 def log_handling(update: Update, level: str, message: str) -> None:
-    """Log message with chat_id and message_id."""
+    """Log message with chat_id and message_id, or the user id of an inline query."""
     _level = getattr(logging, level.upper())
+    if update.inline_query:
+        logger.log(_level, f'[inline:{update.inline_query.from_user.id}] {message}')
+        return
     logger.log(_level, f'[{update.effective_chat.id}:{update.effective_message.message_id}] {message}')
 
 
-def error_handler(update: object, context: CallbackContext) -> None:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
 
-    if isinstance(context.error, telegram.error.Unauthorized):
+    if isinstance(context.error, telegram.error.Forbidden):
         return
 
     if isinstance(context.error, telegram.error.Conflict):
@@ -280,172 +1652,364 @@ def error_handler(update: object, context: CallbackContext) -> None:
         f'{tb_string}'
     )
     string_out = StringIO(message)
-    context.bot.send_document(chat_id=DEVELOPER_ID, document=string_out, filename='error_report.txt',
-                              caption='#error_report\nAn exception was raised during runtime\n')
+    await context.bot.send_document(chat_id=DEVELOPER_ID, document=string_out, filename='error_report.txt',
+                                    caption='#error_report\nAn exception was raised during runtime\n')
 
-    if update:
+    # Inline queries have no message to reply to
+    if isinstance(update, Update) and update.effective_message:
         error_class_name = ".".join([context.error.__class__.__module__, context.error.__class__.__qualname__])
-        update.effective_message.reply_text(f'Error\n{error_class_name}: {str(context.error)}')
+        await update.effective_message.reply_text(f'Error\n{error_class_name}: {str(context.error)}')
 
 
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     log_handling(update, 'info', f'Received /start command from userId {update.effective_user.id}')
     user = update.effective_user
-    update.effective_message.reply_markdown_v2(
+    await update.effective_message.reply_markdown_v2(
         fr'Hi {user.mention_markdown_v2()}\!' +
         '\n發送推文鏈接可以收到原圖哦'
     )
 
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
-    update.effective_message.reply_text('發送推文鏈接可以收到原圖哦')
+    await update.effective_message.reply_text('發送推文鏈接可以收到原圖哦')
 
 
-def stats_command(update: Update, context: CallbackContext) -> None:
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send stats when the command /stats is issued."""
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    logger.info(f'Sent stats: {context.bot_data["stats"]}')
-    update.effective_message.reply_markdown_v2(f'*BOT統計:*\n`已處理訊息媒體 :` *{context.bot_data["stats"].get("messages_handled")}*'
-                                     f'\n`媒體下載 :` *{context.bot_data["stats"].get("media_downloaded")}*')
+    stats = store.counters()
+    logger.info(f'Sent stats: {stats}')
+    await update.effective_message.reply_markdown_v2(f'*BOT統計:*\n`已處理訊息媒體 :` *{stats.get("messages_handled", 0)}*'
+                                                     f'\n`媒體下載 :` *{stats.get("media_downloaded", 0)}*'
+                                                     f'\n`推文緩存 :` *{len(tweet_cache)}* `命中/未命中 :` *{tweet_cache.hits}/{tweet_cache.misses}*'
+                                                     + (f'\n```\n{escape_markdown_v2_code(summary)}\n```' if (summary := metrics.summary()) else ''))
 
 
-def reset_stats_command(update: Update, context: CallbackContext) -> None:
+async def reset_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Reset stats when the command /resetstats is issued."""
-    stats = {'messages_handled': 0, 'media_downloaded': 0}
-    context.bot_data['stats'] = stats
+    store.reset_counters()
     logger.info("Bot stats have been reset")
-    update.effective_message.reply_text("BOT統計已被重置")
+    await update.effective_message.reply_text("BOT統計已被重置")
 
 
-def deny_access(update: Update, context: CallbackContext) -> None:
+async def deny_access(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Deny unauthorized access"""
     log_handling(update, 'info',
                  f'Access denied to {update.effective_user.full_name} (@{update.effective_user.username}),'
                  f' userId {update.effective_user.id}')
-    update.effective_message.reply_text(f'沒有權限哦~')
+    await update.effective_message.reply_text(f'沒有權限哦~')
 
 
-def handle_message(update: Update, context: CallbackContext) -> None:
+@timed('handle_message')
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle the user message. Reply with found supported media."""
     log_handling(update, 'info', 'Received message: ' + update.effective_message.text.replace("\n", ""))
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    context.bot_data['stats']['messages_handled'] += 1
+    store.incr('messages_handled')
 
-    if tweet_ids := extract_tweet_ids(update):
+    if tweet_ids := await extract_tweet_ids(update):
         log_handling(update, 'info', f'Found Tweet IDs {tweet_ids} in message')
     else:
         log_handling(update, 'info', 'No supported tweet link found')
-        update.effective_message.reply_text('未找到受支持的推文鏈接', quote=True)
+        await update.effective_message.reply_text('未找到受支持的推文鏈接', quote=True)
         return
-    found_media = False
-    found_tweets = False
-    for tweet_id in tweet_ids:
-        # Scrape a single tweet by ID
-        log_handling(update, 'info', f'Scraping tweet ID {tweet_id}')
-        try:
-            media = scrape_media(tweet_id)
-            found_tweets = True
-            if media:
-                log_handling(update, 'info', f'tweet media: {media}')
-                if reply_media(update, context, media, tweet_id):
-                    found_media = True
-                else:
-                    log_handling(update, 'info', f'Found unsupported media: {media[0]["type"]}')
-            else:
-                log_handling(update, 'info', f'Tweet {tweet_id} has no media')
-                update.effective_message.reply_text(f'推文 {tweet_id} 沒有媒體', quote=True)
-        except Exception:
-            log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: {traceback.format_exc()}')
-            update.effective_message.reply_text(f'錯誤處理推文 {tweet_id}', quote=True)
-            
+    if JOB_WORKERS:
+        # Worker processes reply from the queue, so the update is kept to rebuild their view of the message
+        queued = [tweet_id for tweet_id in tweet_ids
+                  if tweet_queue.put(update.effective_chat.id, tweet_id, update.to_json())]
+        log_handling(update, 'info', f'Queued Tweet IDs {queued}')
+        return
+    # Prepare all tweets concurrently, then reply in the order the links were sent
+    tasks = [asyncio.create_task(prepare_tweet(update, tweet_id)) for tweet_id in tweet_ids]
+    results = [await reply_tweet(update, context, tweet_id, task) for tweet_id, task in zip(tweet_ids, tasks)]
 
-    if found_tweets and not found_media:
+    if any(result is not None for result in results) and not any(results):
         log_handling(update, 'info', 'No supported media found')
-        update.effective_message.reply_text('不支持的媒體', quote=True)
+        await update.effective_message.reply_text('不支持的媒體', quote=True)
+
+
+inline_flights = SingleFlight('inline')
+
+
+def inline_results(tweet_id: str, entry: dict) -> list:
+    """Build the inline results of a remembered tweet, using file_ids Telegram already has where possible."""
+    caption = generate_markdown_caption(entry['details'])
+    title = f"{entry['details'].get('user_name', 'NONE')} (@{entry['details'].get('user_screen_name', 'NONE')})"
+    results = []
+    for i, (kind, url, thumbnail_url) in enumerate(entry['media']):
+        result_id = f'{tweet_id}:{i}'
+        options = {'caption': caption, 'parse_mode': ParseMode.MARKDOWN_V2}
+        if kind == 'image':
+            results.append(InlineQueryResultCachedPhoto(result_id, file_id, **options)
+                           if (file_id := cached_file_id(url, 'photo'))
+                           else InlineQueryResultPhoto(result_id, url, thumbnail_url, **options))
+        elif kind == 'gif':
+            results.append(InlineQueryResultCachedMpeg4Gif(result_id, file_id, **options)
+                           if (file_id := cached_file_id(url, 'animation'))
+                           else InlineQueryResultMpeg4Gif(result_id, url, thumbnail_url, **options))
+        elif kind == 'video':
+            results.append(InlineQueryResultCachedVideo(result_id, file_id, title, **options)
+                           if (file_id := cached_file_id(url, 'video'))
+                           else InlineQueryResultVideo(result_id, url, 'video/mp4', thumbnail_url, title, **options))
+    return results
+
+
+async def inline_media(update: Update, tweet_id: str) -> Optional[dict]:
+    """Return what a tweet's inline results are built from, scraping the tweet only if it was never seen."""
+    if (entry := store.get('inline', tweet_id)) is not None:
+        return entry
+
+    async def scrape() -> Optional[dict]:
+        async with tweet_slots:
+            await scrape_tweet(update, tweet_id)
+        return store.get('inline', tweet_id)
+
+    # A timeout only stops waiting here, the scrape goes on and answers the next query from the cache
+    return await asyncio.wait_for(inline_flights.do(tweet_id, scrape), INLINE_FETCH_TIMEOUT)
+
+
+@timed('inline_query')
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer an inline query with the media of the tweets linked in it, a page of results at a time."""
+    query = update.inline_query
+    if IS_BOT_PRIVATE and query.from_user.id != DEVELOPER_ID:
+        await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+    tweet_ids = await extract_tweet_ids(update, query.query) if query.query else None
+    if not tweet_ids:
+        await query.answer([], cache_time=INLINE_CACHE_TIME)
+        return
+    results = []
+    complete = True
+    entries = await asyncio.gather(*(inline_media(update, tweet_id) for tweet_id in tweet_ids), return_exceptions=True)
+    for tweet_id, entry in zip(tweet_ids, entries):
+        if isinstance(entry, Exception):
+            log_handling(update, 'info', f'Could not get tweet {tweet_id} for inline query: '
+                                         f'{entry.__class__.__qualname__}: {entry}')
+            complete = False
+        elif entry:
+            results += inline_results(tweet_id, entry)
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(results) else ''
+    # Incomplete answers must not be cached by Telegram, the next try is served from the warmed cache
+    await query.answer(results[offset:offset + INLINE_PAGE_SIZE], next_offset=next_offset,
+                       cache_time=INLINE_CACHE_TIME if complete else 0)
+
+
+async def reply_tweet(update: Update, context: ContextTypes.DEFAULT_TYPE, tweet_id: str,
+                      prepared: Awaitable[Tuple[List[dict], dict, List[str]]]) -> Optional[bool]:
+    """Reply with a prepared tweet. Returns whether it had supported media, or None if it couldn't be scraped."""
+    try:
+        media, tweet_details, photo_urls = await prepared
+        if media:
+            log_handling(update, 'info', f'tweet media: {media}')
+            if await reply_media(update, context, media, tweet_details, photo_urls, tweet_id):
+                return True
+            log_handling(update, 'info', f'Found unsupported media: {media[0]["type"]}')
+        else:
+            log_handling(update, 'info', f'Tweet {tweet_id} has no media')
+            await update.effective_message.reply_text(f'推文 {tweet_id} 沒有媒體', quote=True)
+        return False
+    except Exception:
+        log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: {traceback.format_exc()}')
+        await update.effective_message.reply_text(f'錯誤處理推文 {tweet_id}', quote=True)
+        return None
+
+
+async def process_job(application: Application, job_id: int, tweet_id: str, payload: str, attempts: int) -> None:
+    """Reply with a queued tweet, and only then remove it from the queue."""
+    if attempts > JOB_MAX_ATTEMPTS:
+        logger.error(f'Dropping tweet {tweet_id} of job {job_id} after {JOB_MAX_ATTEMPTS} attempts')
+        tweet_queue.done(job_id)
+        return
+    update = Update.de_json(json.loads(payload), application.bot)
+    context = application.context_types.context.from_update(update, application)
+
+    async def keep_leased() -> None:
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            tweet_queue.renew(job_id)
+
+    lease = asyncio.create_task(keep_leased())
+    try:
+        if await reply_tweet(update, context, tweet_id, prepare_tweet(update, tweet_id)) is False:
+            log_handling(update, 'info', 'No supported media found')
+            await update.effective_message.reply_text('不支持的媒體', quote=True)
+    except Exception:
+        # Left leased, so it is retried once the lease runs out
+        log_handling(update, 'error', f'Job {job_id} failed: {traceback.format_exc()}')
+        return
+    finally:
+        lease.cancel()
+    tweet_queue.done(job_id)
+
+
+async def work(send_share: float) -> None:
+    """Reply to queued tweets until the process is stopped, sending at most send_share of the global send rate."""
+    global send_scheduler
+    send_scheduler = SendScheduler(send_share, shared=True)
+    application = (Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL)
+                   .rate_limiter(send_scheduler).build())
+    await application.initialize()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    running = set()
+
+    async def publish_metrics() -> None:
+        while True:
+            await asyncio.sleep(WORKER_METRICS_INTERVAL)
+            metrics.publish()
+
+    publisher = asyncio.create_task(publish_metrics())
+    try:
+        while True:
+            await slots.acquire()
+            if (job := tweet_queue.claim()) is None:
+                slots.release()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+            task = asyncio.create_task(process_job(application, *job))
+            running.add(task)
+            task.add_done_callback(lambda task: (running.discard(task), slots.release()))
+    finally:
+        publisher.cancel()
+        metrics.publish()
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+def run_worker(send_share: float) -> None:
+    """Run a worker process, e.g. `python main.py worker 0.25`."""
+    if not 0 < send_share <= 1:
+        raise ValueError(f'Worker send share must be in (0, 1], got {send_share}')
+    logger.info(f'Worker started with {send_share:.0%} of the global send rate')
+    asyncio.run(work(send_share))
+
+
+async def post_init(application: Application) -> None:
+    """Set the commands menu and start the metrics endpoint once the bot is initialized."""
+    global _metrics_server
+    bot = application.bot
+
+    if METRICS_PORT:
+        _metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+        logger.info(f'Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics')
 
+    if IS_BOT_PRIVATE:
+        # Set commands menu
+        commands = [BotCommand("start", "啓動BOT"), BotCommand("help", "幫助"),
+                    BotCommand("stats", "獲取統計訊息"), BotCommand("resetstats", "重置BOT統計訊息")]
+        max_retries = 3
+        for attempt in range(max_retries):
+            try:
+                await bot.set_my_commands(commands, scope=BotCommandScopeChat(DEVELOPER_ID),
+                                          read_timeout=(5 + attempt * 5))
+                break
+            except TimedOut as exc:
+                # 如果是超时错误，我们会在日志中记录，并尝试重新设置命令
+                logger.warning(f"超时错误，尝试次数 {attempt + 1}/{max_retries}: {exc}")
+                if attempt == max_retries - 1:
+                    # 如果已经达到最大尝试次数，抛出异常
+                    raise
+            except telegram.error.BadRequest as exc:
+                logger.warning(f"Couldn't set my commands for developer chat: {exc.message}")
+                break
+    else:
+        # Set commands menu
+        # Public commands are useless for now
+        # public_commands = [BotCommand("start", "Start the bot"), BotCommand("help", "Help message")]
+        public_commands = []
+        dev_commands = public_commands + [BotCommand("stats", "Get bot statistics"),
+                                          BotCommand("resetstats", "Reset bot statistics")]
+        await bot.set_my_commands(public_commands)
+        try:
+            await bot.set_my_commands(dev_commands, scope=BotCommandScopeChat(DEVELOPER_ID))
+        except telegram.error.BadRequest as exc:
+            logger.warning(f"Couldn't set my commands for developer chat: {exc.message}")
 
-def main() -> None:
-    """Start the bot."""
-    makedirs('data', exist_ok=True)  # Create data
-    persistence = PicklePersistence(filename='data/persistence')
 
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(BOT_TOKEN, persistence=persistence)
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP client and the metrics endpoint."""
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _metrics_server is not None:
+        _metrics_server.close()
+
 
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+def build_application() -> Application:
+    """Create the application with its persistence, send scheduler and handlers."""
+    persistence = SQLitePersistence(store, update_interval=PERSISTENCE_UPDATE_INTERVAL)
 
-    # Get the bot to set commands menu
-    bot = dispatcher.bot
+    # Create the Application and pass it your bot's token.
+    # Updates are handled as concurrent tasks on one event loop instead of a thread each.
+    application = (Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL)
+                   .persistence(persistence).rate_limiter(send_scheduler).concurrent_updates(CONCURRENT_UPDATES)
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
 
-    dispatcher.add_handler(CommandHandler("stats", stats_command, Filters.chat(DEVELOPER_ID)))
-    dispatcher.add_handler(CommandHandler("resetstats", reset_stats_command, Filters.chat(DEVELOPER_ID)))
+    application.add_handler(CommandHandler("stats", stats_command, filters.Chat(DEVELOPER_ID)))
+    application.add_handler(CommandHandler("resetstats", reset_stats_command, filters.Chat(DEVELOPER_ID)))
 
     if IS_BOT_PRIVATE:
         # Deny access to everyone but developer
-        dispatcher.add_handler(MessageHandler(~Filters.chat(DEVELOPER_ID), deny_access))
+        application.add_handler(MessageHandler(~filters.Chat(DEVELOPER_ID), deny_access))
 
         # on different commands - answer in Telegram
-        dispatcher.add_handler(CommandHandler("start", start, Filters.chat(DEVELOPER_ID)))
-        dispatcher.add_handler(CommandHandler("help", help_command, Filters.chat(DEVELOPER_ID)))
+        application.add_handler(CommandHandler("start", start, filters.Chat(DEVELOPER_ID)))
+        application.add_handler(CommandHandler("help", help_command, filters.Chat(DEVELOPER_ID)))
 
         # on non command i.e message - handle the message
-        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command & Filters.chat(DEVELOPER_ID),
-                                              handle_message, run_async=True))
-
-        # Set commands menu
-        commands = [BotCommand("start", "啓動BOT"), BotCommand("help", "幫助"),
-                    BotCommand("stats", "獲取統計訊息"), BotCommand("resetstats", "重置BOT統計訊息")]
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            bot.set_my_commands(commands, scope=BotCommandScopeChat(DEVELOPER_ID), timeout=(5 + attempt * 5))
-            break
-        except TimedOut as exc:
-            # 如果是超时错误，我们会在日志中记录，并尝试重新设置命令
-            logger.warning(f"超时错误，尝试次数 {attempt + 1}/{max_retries}: {exc}")
-            if attempt == max_retries - 1:
-                # 如果已经达到最大尝试次数，抛出异常
-                raise    
-        except telegram.error.BadRequest as exc:
-            logger.warning(f"Couldn't set my commands for developer chat: {exc.message}")
-            break
-
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Chat(DEVELOPER_ID),
+                                               handle_message))
     else:
         # on different commands - answer in Telegram
-        dispatcher.add_handler(CommandHandler("start", start))
-        dispatcher.add_handler(CommandHandler("help", help_command))
+        application.add_handler(CommandHandler("start", start))
+        application.add_handler(CommandHandler("help", help_command))
 
         # on non command i.e message - handle the message
-        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message, run_async=True))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-        # Set commands menu
-        # Public commands are useless for now
-        # public_commands = [BotCommand("start", "Start the bot"), BotCommand("help", "Help message")]
-        public_commands = []
-        dev_commands = public_commands + [BotCommand("stats", "Get bot statistics"),
-                                          BotCommand("resetstats", "Reset bot statistics")]
-        bot.set_my_commands(public_commands)
-        try:
-            bot.set_my_commands(dev_commands, scope=BotCommandScopeChat(DEVELOPER_ID))
-        except telegram.error.BadRequest as exc:
-            logger.warning(f"Couldn't set my commands for developer chat: {exc.message}")
+    application.add_handler(InlineQueryHandler(inline_query))
+
+    application.add_error_handler(error_handler)
+    return application
 
-    dispatcher.add_error_handler(error_handler)
 
-    # Start the Bot
-    updater.start_polling()
+def main() -> None:
+    """Start the bot."""
+    makedirs('data', exist_ok=True)  # Create data
+    if sys.argv[1:2] == ['worker']:
+        # Standalone workers run next to the bot's own, so the operator decides how the send rate is split
+        try:
+            send_share = float(sys.argv[2])
+        except (IndexError, ValueError):
+            send_share = 0
+        if not 0 < send_share <= 1:
+            raise SystemExit('Usage: python main.py worker SHARE\n'
+                             'SHARE (0 < SHARE <= 1) is the part of GLOBAL_SEND_RATE this worker may use; '
+                             'the shares of all workers should add up to at most 1')
+        run_worker(send_share)
+        return
+    if UPDATE_MODE == 'webhook' and not WEBHOOK_SECRET_TOKEN:
+        # Without it anyone who finds the listener could post fake updates
+        raise SystemExit('WEBHOOK_SECRET_TOKEN must be set to use webhook mode')
+    migrate_pickle_persistence('data/persistence')
+    application = build_application()
+
+    # Left by the workers of an earlier run; running workers publish theirs again
+    store.clear('metrics')
+    # Spawned rather than forked, so no worker inherits this process's database connections
+    for _ in range(JOB_WORKERS):
+        multiprocessing.get_context('spawn').Process(target=run_worker, args=(1 / JOB_WORKERS,), daemon=True).start()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # it stops the bot gracefully.
+    if UPDATE_MODE == 'webhook':
+        # Telegram pushes updates to the built-in listener, which rejects requests without the secret token
+        application.run_webhook(listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                                webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN,
+                                max_connections=WEBHOOK_MAX_CONNECTIONS)
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':